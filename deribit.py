@@ -1,120 +1,36 @@
-import asyncio
-import websockets # Can be installed via anaconda environments
-import json
-import pandas as pd
 import datetime as dt
-import time
-import nest_asyncio # Use anaconda prompt if not installed
-nest_asyncio.apply()
+import json
+import logging
 import os
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
 
-async def call_api(msg):
-    async with websockets.connect('wss://test.deribit.com/ws/api/v2') as websocket:
-        await websocket.send(msg)
-        while websocket.open:
-            response = await websocket.recv()
-            return response
-
-
-def async_loop(api, message):
-    return asyncio.get_event_loop().run_until_complete(api(message))
-
-
-def retrieve_historic_data(start, end, instrument, timeframe):
-    msg = \
-        {
-            "jsonrpc": "2.0",
-            "id": 833,
-            "method": "public/get_tradingview_chart_data",
-            "params": {
-                "instrument_name": instrument,
-                "start_timestamp": start,
-                "end_timestamp": end,
-                "resolution": timeframe
-            }
-        }
-    resp = async_loop(call_api, json.dumps(msg))
-
-    return resp
-
-
-# Convert Json to DataFrame
-
-def json_to_dataframe(json_resp):
-    res = json.loads(json_resp)
-
-    df = pd.DataFrame(res['result'])
-
-    df['ticks'] = df.ticks / 1000
-    df['timestamp'] = [dt.datetime.utcfromtimestamp(date) for date in df.ticks]
-
-    return df
-
+# All functions and classes of this script are defined in deribit_lib.py, which has no cells and can be
+# imported on its own (e.g. by the tests). The mock server and the fetch benchmark are in deribit_mock.py,
+# imported by the benchmark cell only
 
-# Define a function to get data on a certain instrument using its name and 2 timestamps, between which this instrument was traded
+from deribit_lib import *
 
-def get_data(date1, date2, instrument, tf='1'):
-    
-    # Collect data in daily steps
-    
-    n_days = (date2 - date1).days
-    df_complete = pd.DataFrame()
 
-    d1 = date1
-    for _ in range(n_days):
-        
-        # Assumption: Both dates between which the data is collected are saved/given in datetime.datetime format
-        d2 = d1 + dt.timedelta(days=1)
-
-        t1 = dt.datetime.timestamp(d1) * 1000
-        t2 = dt.datetime.timestamp(d2) * 1000    
-    
-        json_resp = retrieve_historic_data(t1, t2, instrument, tf)
-    
-        temp_df = json_to_dataframe(json_resp)
-    
-        df_complete = df_complete.append(temp_df)
-        
-        # Pause for some time to be able to collect further data
-        
-        print(f'collected data for dates: {d1.isoformat()} to {d2.isoformat()}')
-        print('sleeping for 0.3 seconds')
-        time.sleep(0.3)
-        
-        d1 = d2
-        
-    # Delete unnecessary columns
-    
-    keep = ['volume', 'cost', 'open', 'low', 'high', 'close', 'timestamp']
+##########################################################################################
+#%%
 
-    df_complete = df_complete.loc[:,keep]
-    
-    # Convert timestamps into datetime format
-    df_complete['timestamp'] = pd.to_datetime(df_complete['timestamp'], infer_datetime_format=True)
 
-    # Filter out duplicates
-    df_complete.drop_duplicates(subset=['timestamp'],
-                                keep='first',
-                                inplace=True)
-
-    # Set timestamps as index
-    df_complete = df_complete.set_index("timestamp")   
-    
-    # If you don't want to set timestamps as index, just reset the index
-    # df_filtered.reset_index(inplace=True)    
-        
-    return df_complete
+# Progress and metrics are logged (use level=logging.DEBUG to see every collected chunk)
 
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
+# Metrics can also be written for Prometheus, e.g.:
+# metrics.exporters.append(PrometheusExporter(r'E:\Metrics\deribit.prom'))
 
 
-##########################################################################################
 #%%
 
-
 # Example #1 (Perpetual contract)
 
-# start: First timestamp to collect data (YYYY, M, D, h, min)
+# start: First timestamp to collect data (YYYY, M, D, h, min), in UTC like all times in this script
 start = dt.datetime(2021, 2, 6, 0, 0)
 
 # end:First timestamp to collect data (YYYY, M, D, h, min)
@@ -176,345 +92,281 @@ df_example3 = get_data(start, end, instrument, tf)
 # df_example3.to_csv("btc_option.csv")
 
 
-
-
-##########################################################################################
 #%%
 
 # =============================================================================
-# Getting all Data on Perpetual Contract:    on DAILY BASIS
+# Benchmark: building a minute series from chunks (CandleAccumulator)
 # =============================================================================
-    
 
-start = dt.datetime(2018, 8, 13, 0, 0)  
-end = dt.datetime(2021, 3, 31, 0, 0)
-instrument = "BTC-PERPETUAL"
-tf = "1D"
+# Feeds synthetic full-size chunks into the accumulator and reports time and peak memory.
+# Both should grow linearly with the number of rows (constant time and bytes per row).
 
-df_perp = get_data(start, end, instrument, tf)
-df_perp.to_csv(r'E:\Perpetual\perpetual_daily.csv')
+def benchmark_accumulator(sizes=(100_000, 500_000, 1_000_000, 2_000_000, 4_000_000), chunk=MAX_CANDLES):
+    rows = []
 
+    for n_rows in sizes:
+        ticks = np.arange(n_rows, dtype='int64') * 60000 + 1533081600000
+        results = [{col: ticks[k:k + chunk].tolist() for col in ['ticks'] + CANDLE_COLUMNS}
+                   for k in range(0, n_rows, chunk)]
 
-# The data on perpetual contract starts on 13th of August 2018 (2018-08-13)
+        tracemalloc.start()
+        t0 = time.perf_counter()
 
+        candles = CandleAccumulator()
+        for result in results:
+            candles.add(result)
+        df = candles.to_dataframe()
 
-#%%
+        seconds = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
 
-# =============================================================================
-# Getting all Data on Perpetual Contract:    on HOURLY BASIS
-# =============================================================================
+        rows.append({'rows': len(df), 'seconds': seconds, 'peak_mb': peak / 2**20,
+                     'us_per_row': seconds / n_rows * 1e6, 'bytes_per_row': peak / n_rows})
 
+    return pd.DataFrame(rows)
 
-start = dt.datetime(2018, 8, 13, 10, 0)  
-end = dt.datetime(2021, 3, 31, 9, 0)
-instrument = "BTC-PERPETUAL"
-tf = "60"
 
-df_perp = get_data(start, end, instrument, tf)
-df_perp.to_csv(r'E:\Perpetual\perpetual_hourly.csv')
+df_bench_acc = benchmark_accumulator()
+print(df_bench_acc)
 
 
 #%%
 
 # =============================================================================
-# Getting all Data on Perpetual Contract:    on MINUTELY BASIS
+# Benchmark: decoding one response (json_to_dataframe)
 # =============================================================================
 
+# Compares the per-chunk cost of the original decoding (json.loads, DataFrame of the result,
+# datetime list built in Python) with the current one (fast parser if installed, arrays copied
+# straight into NumPy buffers, vectorized timestamps)
 
-start = dt.datetime(2018, 8, 13, 10, 0)  
-end = dt.datetime(2021, 3, 31, 9, 0)
-instrument = "BTC-PERPETUAL"
-tf = "1"
 
-df_perp = get_data(start, end, instrument, tf)
-df_perp.to_csv(r'E:\Perpetual\perpetual_minutely.csv')
+def json_to_dataframe_original(json_resp):
+    res = json.loads(json_resp)
 
+    df = pd.DataFrame(res['result'])
 
+    df['ticks'] = df.ticks / 1000
+    df['timestamp'] = [dt.datetime.utcfromtimestamp(date) for date in df.ticks]
 
+    return df
 
 
+def benchmark_decode(n_candles=MAX_CANDLES, repeat=20):
+    ticks = np.arange(n_candles, dtype='int64') * 60000 + 1533081600000
+    result = {col: (ticks / 1000).tolist() for col in CANDLE_COLUMNS}
+    result['ticks'] = ticks.tolist()
+    result['status'] = 'ok'
+    json_resp = json.dumps({"jsonrpc": "2.0", "id": 1, "result": result})
 
+    rows = []
+    for name, decode in [('original', json_to_dataframe_original), ('json_to_dataframe', json_to_dataframe)]:
+        t0 = time.perf_counter()
+        for _ in range(repeat):
+            decode(json_resp)
+        seconds = (time.perf_counter() - t0) / repeat
+        rows.append({'decoder': name, 'ms_per_chunk': seconds * 1000, 'candles_per_s': n_candles / seconds})
 
+    return pd.DataFrame(rows)
 
 
+df_bench_decode = benchmark_decode()
+print(df_bench_decode)
+
 
-##########################################################################################
 #%%
-    
-    
+
 # =============================================================================
-# ### Options: Basic information
+# Benchmark: fetch throughput against the mock server
 # =============================================================================
 
+# Each scenario reports requests/s, candles/s, the p50/p99 latency of single requests (send to response)
+# and the peak RSS of the process so far (it never goes down, so compare scenarios in the order they ran).
+# With unlimited=True the client's token bucket is switched off to measure the fetch code itself
+# (the session is pointed at the mock server for the benchmark and back afterwards).
 
-# Expiration Dates
+from deribit_mock import benchmark_fetch
 
-# Except for the 24-hour period following the introduction of a new expiry, two expiries of daily options, three expiries of weekly options, three expiries of monthly options and four expiries of quarterly options are available to trade.
+df_bench_fetch = benchmark_fetch()
+print(df_bench_fetch)
 
-# 1, 2 daily
-# 1, 2, 3 weekly
-# 1, 2, 3 monthly
-# 3, 6, 9 and 12 months quarterly of the March, June, September, December cycle.
 
-# Daily options expire every day at 08:00 UTC.
-# Weekly options expire on each Friday of each week at 08.00 UTC.
-# Monthly options expire on the last Friday of each calendar month at 08.00 UTC.
-# Quarterly options expire on the last Friday of each calendar quarter at 08.00 UTC.
 
 
-# Options: Introduction of new expiries
-        
-# A new options expiry date is added on Thursday immediately prior to expiration Friday except:
+##########################################################################################
+#%%
 
-# A monthly expiry will not be added it if already exists as a quarterly expiry. Instead, this quarterly expiry will now be considered a monthly expiry.
-# A weekly will not be added it if already exists as a monthly expiry. Instead, this monthly expiry will now be considered a weekly expiry
+# =============================================================================
+# # Import the CSV files of earlier runs (before downloading anything)
+# =============================================================================
 
-# Daily options are added the day immediately preceding the expiry day ( 08.00 UTC) and have therefore an initial lifetime of two trading days at the time of introduction.
+# Candles found in the old E:/Options, E:/Futures and E:/Perpetual trees go into the dataset and the
+# candle cache, so the downloads below only request what is missing. Files already imported are skipped
 
+for archive in [r'E:/Options', r'E:/Futures', r'E:/Perpetual']:
+    df_imported = import_legacy(archive, perpetual="BTC-PERPETUAL")
+    print(archive, df_imported[["rows", "invalid", "duplicates", "imported"]].sum().to_dict())
+    print(df_imported[df_imported["error"].notna()])
 
 
-##########################################################################################
 #%%
 
-# Function to retrieve various information about a certain instrument (of main importance: creation & expiration dates)
-
-def get_instrument(instrument): 
-    msg = \
-        {
-                "method" : "public/get_instrument",
-                "params" : {
-                        "instrument_name" : instrument
-                        },
-                        "jsonrpc" : "2.0",
-                        "id" : 0
-                }                   
-    resp = async_loop(call_api, json.dumps(msg))
-
-    return resp
+# =============================================================================
+# Getting all Data on Perpetual Contract:    on MINUTELY BASIS
+# =============================================================================
 
+# The data on perpetual contract starts on 13th of August 2018 (2018-08-13)
 
-def json_to_datafr(json_resp):
-    res = json.loads(json_resp)
-    
-    # Simple indexing of a DataFrame to prevent ValueError
-    df = pd.DataFrame(res['result'], index = [0])
-    
-    return df
+start = dt.datetime(2018, 8, 13, 10, 0)  
+end = dt.datetime(2021, 3, 31, 9, 0)
+instrument = "BTC-PERPETUAL"
+tf = "1"
 
+# Minute data for several years doesn't need to fit in memory: chunks are written to the dataset
+# and to a memory-mapped copy (for fast slicing) as soon as they arrive. Candles imported above are
+# taken from the candle cache, only the rest is downloaded
 
-def instrument_info(instrument):    
-    json_inst = get_instrument(instrument)
-    df_inst = json_to_datafr(json_inst)
-    
-    return df_inst
+parquet_path = os.path.join(partition_dir(STORE_DIR, "BTC", "future", "perpetual", tf), instrument + '.parquet')
 
+with ParquetSink(parquet_path, instrument) as parquet_sink, MemmapSink(r'E:\Perpetual\perpetual_minutely') as memmap_sink:
+    for chunk in iter_candles(start, end, instrument, tf):
+        parquet_sink.write(chunk)
+        memmap_sink.write(chunk)
 
-#%%   
 
-# Example to "instrument_info" - function
-    
-opt_info_traded = instrument_info("BTC-24SEP21-80000-P")
+#%%
 
-opt_info_expired = instrument_info("BTC-25MAR21-50000-P")
+# =============================================================================
+# Getting all Data on Perpetual Contract:    on HOURLY and DAILY BASIS
+# =============================================================================
 
+# Derived from the minute candles above instead of downloading them again
 
-df_info_ex = pd.DataFrame()
-df_info_ex = df_info_ex.append(opt_info_traded)
-df_info_ex = df_info_ex.append(opt_info_expired)
+perp_minutely = MemmapSeries(r'E:\Perpetual\perpetual_minutely')
 
+for tf in ["60", "1D"]:
+    df_perp = resample_candles(perp_minutely.slice(), tf)
+    write_candles(df_perp, instrument, tf, "BTC", "future", "perpetual")
 
-    
 
 #%%
 
+# Check the resampled candles against the candles of the server on a few random ranges
+# (every column should have 0 differences)
 
-# =============================================================================
-#  Loop to get each overall data on each previously existing instrument (names, creation/expiration timestamps)    
-# =============================================================================
+df_perp_minutely = perp_minutely.to_dataframe()
 
+for tf in ["60", "1D"]:
+    print(tf)
+    print(check_resample(df_perp_minutely, instrument, tf, n_samples=5))
 
-# DF including all options in 2018
 
+#%%
 
-currency = "BTC"                        # Define trading currency(Bitcoin: "BTC" or Etherium: "ETH")
-str_range = range(1000, 61000, 1000)    # Define a range of possible strike prices for an option and a reasonable step
+# Example: slice one week of minute candles without loading the whole series
 
+week = perp_minutely.slice(dt.datetime(2021, 2, 1), dt.datetime(2021, 2, 8))
+week_close = week['close']          # numpy view on the file, nothing is read until used
 
-# Create an empty DataFrame to collect data on existing instruments
-df_info = pd.DataFrame()
 
+#%%
 
-# A loop that changes the art of the option (Put: "P", Call: "C")
-for art in ["P","C"]:
-    
-    # A loop that goes through all possible expiration dates in 2018
-    # A loop over all years is also possible, but in that case the code would retrieve data for several days
-    for year in range(18,19):
-        for month in ['JAN','FEB','MAR', 'APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC']:
-            for num in range(1,32):
-                day = str(num) + month + str(year)
-                
-                # A loop that goes through all possible strike prices
-                for strike in str_range:
-                    
-                    # Principle: Check if an option exists, if yes: save its name to a list (DF)                     
-                    try: 
-                        # Construct an instrument name if one exists for chosen option art, expiration date and strike price
-                        instrument = currency + "-" + day + "-" + str(strike) + "-" + art
-                        print(instrument)
-                        
-                        df_info = df_info.append(instrument_info(instrument))   #Add collected data to a DF
-                        
-                    except KeyError:
-                        print("No such instrument")
-                                        
+# =============================================================================
+# Raw trades of the perpetual contract (tick data)
+# =============================================================================
 
-df_info.to_csv(r'E:\Options\options_list2.csv')
+# Written slice by slice as typed columns (see TRADE_COLUMNS); append=True continues an earlier download
 
-#%%
+n_trades = download_trades(dt.datetime(2021, 1, 1), dt.datetime(2021, 4, 1), "BTC-PERPETUAL", r'E:\Perpetual\perpetual_trades')
+print(n_trades)
 
-# Loop to get each previously or currently existing instrument   
+perp_trades = MemmapSeries(r'E:\Perpetual\perpetual_trades', TRADE_COLUMNS)
+df_trades_day = perp_trades.to_dataframe(dt.datetime(2021, 2, 1), dt.datetime(2021, 2, 2))
 
-# Possible: List of all option names / dataframe with info to each existing option     
 
 
-# DF including all options in 2019
 
-currency = "BTC"
-str_range = range(1000, 81000, 1000)
 
-# Creating an empty DataFrame to collect data on existing instruments
-df_info2 = pd.DataFrame()
 
 
-for art in ["P","C"]:
-    
-    for year in range(19,20):
-        for month in ['JAN','FEB','MAR', 'APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC']:
-            for num in range(1,32):
-                day = str(num) + month + str(year)
-                
-                for strike in str_range:
-                    
-                    try: 
-                        instrument = currency + "-" + day + "-" + str(strike) + "-" + art
-                        print(instrument)
-                        
-                        df_info2 = df_info2.append(instrument_info(instrument))
-                        
-                    except KeyError:
-                        print("No such instrument")
-                        
 
-df_info2.to_csv(r'E:\Options\options_list2.csv')
 
 
+##########################################################################################
 #%%
+    
+    
+# =============================================================================
+# ### Options: Basic information
+# =============================================================================
 
-# DF including all options in 2020
 
-currency = "BTC"
-str_range = range(1000, 121000, 1000)
+# Expiration Dates
 
-# Creating an empty DataFrame to collect data on existing instruments
-df_info3 = pd.DataFrame()
+# Except for the 24-hour period following the introduction of a new expiry, two expiries of daily options, three expiries of weekly options, three expiries of monthly options and four expiries of quarterly options are available to trade.
 
+# 1, 2 daily
+# 1, 2, 3 weekly
+# 1, 2, 3 monthly
+# 3, 6, 9 and 12 months quarterly of the March, June, September, December cycle.
 
-for art in ["P","C"]:
-    
-    for year in range(20,21):
-        for month in ['JAN','FEB','MAR', 'APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC']:
-            for num in range(1,32):
-                day = str(num) + month + str(year)
-                
-                for strike in str_range:
-                    
-                    try: 
-                        instrument = currency + "-" + day + "-" + str(strike) + "-" + art
-                        print(instrument)
-                        
-                        df_info3 = df_info3.append(instrument_info(instrument))
-                        
-                    except KeyError:
-                        print("No such instrument")
-                        
+# Daily options expire every day at 08:00 UTC.
+# Weekly options expire on each Friday of each week at 08.00 UTC.
+# Monthly options expire on the last Friday of each calendar month at 08.00 UTC.
+# Quarterly options expire on the last Friday of each calendar quarter at 08.00 UTC.
 
-df_info3.to_csv(r'E:\Options\options_list3.csv')
 
+# Options: Introduction of new expiries
+        
+# A new options expiry date is added on Thursday immediately prior to expiration Friday except:
 
-#%%
+# A monthly expiry will not be added it if already exists as a quarterly expiry. Instead, this quarterly expiry will now be considered a monthly expiry.
+# A weekly will not be added it if already exists as a monthly expiry. Instead, this monthly expiry will now be considered a weekly expiry
 
-# DF including all options 2021
+# Daily options are added the day immediately preceding the expiry day ( 08.00 UTC) and have therefore an initial lifetime of two trading days at the time of introduction.
 
-currency = "BTC"
-str_range = range(1000, 301000, 1000)
 
-# Creating an empty DataFrame to collect data on existing instruments
-df_info4 = pd.DataFrame()
 
+##########################################################################################
+#%%   
 
-for art in ["P","C"]:
+# Example to "instrument_info" - function
     
-    for year in range(21,22):
-        for month in ['JAN','FEB','MAR', 'APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC']:
-            for num in range(1,32):
-                day = str(num) + month + str(year)
-                
-                for strike in str_range:
-                    
-                    try: 
-                        instrument = currency + "-" + day + "-" + str(strike) + "-" + art
-                        print(instrument)
-                        
-                        df_info4 = df_info4.append(instrument_info(instrument))
-                        
-                    except KeyError:
-                        print("No such instrument")
-                        
-
-df_info4.to_csv(r'E:\Options\options_list4.csv')
-
+opt_info_traded = instrument_info("BTC-24SEP21-80000-P")
 
+opt_info_expired = instrument_info("BTC-25MAR21-50000-P")
 
 
+df_info_ex = pd.concat([opt_info_traded, opt_info_expired])
 
-#%%
+# Asked again (also after a restart), the expired option comes from the instrument cache without a request;
+# instrument_info(name, cache=None) always asks the API
+print(instrument_info("BTC-25MAR21-50000-P").equals(opt_info_expired))
 
-# Adjust of the resulting DataFrame for further computations (Definition)
 
-def adjust_df(df):
     
-    # Reset index from 0s
-    df = df.reset_index()
-    
-    # Change timestamps to datetme format
-    df["creation_timestamp"] = df["creation_timestamp"]/1000
-    df["creation_timestamp"] = [dt.datetime.utcfromtimestamp(date) for date in df["creation_timestamp"]]
-    
-    df["expiration_timestamp"] = df["expiration_timestamp"]/1000
-    df["expiration_timestamp"] = [dt.datetime.utcfromtimestamp(date) for date in df["expiration_timestamp"]]
-    
-    # Drop an additional index column
-    df = df.drop(['index'], axis=1)
-    
-    return df
-
 
 #%%
 
-# Adjust the resulting DataFrame for further computations (Adjustment)
+# Build the catalog of all BTC options and futures (or load a saved one with load_catalog)
+
+currency = "BTC"                        # Define trading currency(Bitcoin: "BTC" or Etherium: "ETH")
 
-df_info = adjust_df(df_info)
-df_info2 = adjust_df(df_info2)
-df_info3 = adjust_df(df_info3)
-df_info4 = adjust_df(df_info4)
+df_catalog = instrument_catalog([currency], ["option", "future"])
+save_catalog(df_catalog, r'E:\Options\instruments_btc.csv')
 
-# Save the adjusted DataFrames without an index column
+# Option lists per year of expiration (without an index column)
 
-#df_info.to_csv(r'E:\Options\options_list_2018.csv', index=False)
-#df_info2.to_csv(r'E:\Options\options_list_2019.csv', index=False)
-#df_info3.to_csv(r'E:\Options\options_list_2020.csv', index=False)
-#df_info4.to_csv(r'E:\Options\options_list_2021.csv', index=False)
+df_info = select_instruments(df_catalog, "option", "2018", "2018")
+df_info2 = select_instruments(df_catalog, "option", "2019", "2019")
+df_info3 = select_instruments(df_catalog, "option", "2020", "2020")
+df_info4 = select_instruments(df_catalog, "option", "2021", "2021")
+
+df_info.to_csv(r'E:\Options\options_list_2018.csv', index=False)
+df_info2.to_csv(r'E:\Options\options_list_2019.csv', index=False)
+df_info3.to_csv(r'E:\Options\options_list_2020.csv', index=False)
+df_info4.to_csv(r'E:\Options\options_list_2021.csv', index=False)
 
 
 
@@ -561,10 +413,9 @@ df_info = pd.read_csv(file)
 
 #%%
 
-# Convert strings to datetime format
-for i in range(len(df_info.index)):
-    df_info.loc[i,"creation_timestamp"] = dt.datetime.strptime(df_info.loc[i,"creation_timestamp"], "%Y-%m-%d %H:%M:%S")
-    df_info.loc[i,"expiration_timestamp"] = dt.datetime.strptime(df_info.loc[i,"expiration_timestamp"], "%Y-%m-%d %H:%M:%S")
+# Convert strings to datetime format (whole columns at once, as UTC)
+df_info["creation_timestamp"] = pd.to_datetime(df_info["creation_timestamp"], utc=True)
+df_info["expiration_timestamp"] = pd.to_datetime(df_info["expiration_timestamp"], utc=True)
 
 
 #%%
@@ -572,63 +423,106 @@ for i in range(len(df_info.index)):
 # Example: get data for just one option (Same option as in example #4)
 
 tf = "1D"
-i = 1350    # instrument = "BTC-26MAR21-36000-P"
-
+instrument_index = InstrumentIndex(df_info)
+option = instrument_index.select(option_type="put", expiry="26MAR21", strike_min=36000, strike_max=36000).iloc[0]
 
-start = df_info.loc[i,"creation_timestamp"]
+start = option["creation_timestamp"]
 print(start)
-end = df_info.loc[i,"expiration_timestamp"]
+end = option["expiration_timestamp"]
 print(end)
     
-instrument = df_info.loc[i,"instrument_name"]
+instrument = option["instrument_name"]
 print(instrument)
     
 df_option = get_data(start, end, instrument, tf)
 
 
+#%%
+
+# Example: the puts of one expiry within a strike range, and all options of a strike range
+
+df_puts = instrument_index.select(option_type="put", expiry="26MAR21", strike_min=30000, strike_max=40000)
+print(df_puts[["instrument_name", "strike"]])
+
+df_near = instrument_index.select(strike_min=35000, strike_max=37000)
+print(len(df_near), instrument_index.expiries()[:5])
+
 
 #%%
 
 # =============================================================================
-# # A loop that collects all data for each instrument in a DataFrame
+# # Download all data for each instrument (resumable)
 # =============================================================================
 
 # To get data on each option we use a predefined function "get_data(start, end, instrument, tf)"
-# We also use known option names as well as their creation & expiration timestamps
+# We also use known option names as well as their creation & expiration timestamps.
+# Progress is kept in a journal: if the download stops, running this cell again continues where it stopped
 
 tf = "1D"
-df_error = []
 
-for i in range(len(df_info.index)):
-    
-    try:
-        
-        start = df_info.loc[i,"creation_timestamp"]
-        end = df_info.loc[i,"expiration_timestamp"]
-        print(end)
-        
-        instrument = df_info.loc[i,"instrument_name"]
-        
-        df_option = get_data(start, end, instrument, tf)
-        
-        # Cut out expiration date from the instrument name to create a directory for that date
-        
-        day = instrument[4:11]
-        os.makedirs("E:/Options/Daily/"+ day, exist_ok=True)  # Creates a new path for each new expiration date (PROBLEM: Dates below 10th of each month)
-        df_option.to_csv(r'E:/Options/Daily/'+ day +'/option-daily_'+ instrument +'.csv')
-        
-    except KeyError:
-        
-        print("Error when collecting data")
-        df_error += [instrument]
+os.makedirs("E:/Options/Daily", exist_ok=True)
+journal = DownloadJournal(r'E:/Options/Daily/downloads_2021.sqlite')
+journal.add(download_units(df_info, [tf]))
+
+print(run_downloads(journal))
 
 
 #%%
+
+# Instruments that still failed after all attempts
         
-errors = pd.Series(df_error)
+errors = journal.failed()
 errors.to_csv(r'E:/Options/Daily/errors_2021.csv', index= False)
 
 
+#%%
+
+# Example: load a whole option chain (one expiry) from the dataset in one query,
+# reading only the needed columns and strikes between 30000 and 40000
+
+df_chain = read_candles(columns=['timestamp', 'instrument_name', 'strike', 'option_type', 'close'],
+                        currency="BTC", kind="option", expiry="2021-03-26", tf="1D",
+                        strike_min=30000, strike_max=40000)
+
+
+#%%
+
+# Example: the same expiry as a panel (time × strike × call/put arrays per field)
+
+chain = option_chain_panel("2021-03-26", tf="1D", catalog=df_catalog)
+
+chain_close = chain["close"]                            # NumPy array, shape chain.shape
+df_calls_close = chain.frame("close", "call")           # time × strike
+df_smile = chain.at(dt.datetime(2021, 3, 1), "close")   # strike × (call, put) on one day
+
+
+#%%
+
+# Benchmark: implied volatilities per second on one core (random options between 1 day and 1.5 years
+# to expiry, strikes within ±50% of the underlying, volatilities between 20% and 250%). Deep
+# in-the-money options whose time value is lost in rounding can't be solved accurately (or at all)
+
+def benchmark_implied_vol(n=1_000_000, seed=0):
+    rng = np.random.default_rng(seed)
+    f = rng.uniform(10000, 60000, n)
+    k = f * np.exp(rng.uniform(-0.5, 0.5, n))
+    t = rng.uniform(1 / 365, 1.5, n)
+    sigma = rng.uniform(0.2, 2.5, n)
+    is_call = rng.random(n) < 0.5
+
+    price = black76_price(f, k, t, sigma, is_call)
+
+    t0 = time.perf_counter()
+    iv = implied_vol(price, f, k, t, is_call)
+    seconds = time.perf_counter() - t0
+
+    return {'options': n, 'seconds': seconds, 'options_per_s': n / seconds,
+            'error_p99.9': np.nanpercentile(np.abs(iv - sigma), 99.9), 'not_solved': int(np.isnan(iv).sum())}
+
+
+print(benchmark_implied_vol())
+
+
 
 
 
@@ -681,36 +575,10 @@ df_example4 = get_data(start, end, instrument, tf)
 # Create a DF which includes all BTC futures names, their creation and expiration timestamps
 # =============================================================================
 
-currency = "BTC"
-
-# Creating an empty DataFrame to collect data on existing instruments
-df_fut = pd.DataFrame()
-
-
-for year in range(18,22):
-    for month in ['JAN','FEB','MAR', 'APR','MAY','JUN','JUL','AUG','SEP','OCT','NOV','DEC']:
-        for num in range(1,32):
-            day = str(num) + month + str(year)
-                
-            try: 
-                instrument = currency + "-" + day
-                print(instrument)
-                        
-                df_fut = df_fut.append(instrument_info(instrument))
-                        
-            except KeyError:
-                print("No such instrument")
-                        
-
-df_fut.to_csv(r'E:\Futures\futures_list_raw.csv', index=False)
+# All futures from the instrument catalog (built in the options section); the perpetual contract is listed as a future as well
 
-
-
-#%%
-
-# Adjust the resulting DataFrame for further computations (Adjustment)
-
-df_fut = adjust_df(df_fut)
+df_fut = select_instruments(df_catalog, "future")
+df_fut = df_fut[df_fut["settlement_period"] != "perpetual"].reset_index(drop=True)
 
 df_fut.to_csv(r'E:\Futures\futures_list.csv', index=False)
 
@@ -720,7 +588,7 @@ df_fut.to_csv(r'E:\Futures\futures_list.csv', index=False)
 #%%
 
 # =============================================================================
-# Here you can work with a DF created with a loop in rows 678-718 or yoy can directly load the resulting table
+# Here you can work with a DF created from the instrument catalog above or yoy can directly load the resulting table
 # =============================================================================
 
 # Load data for a certain year (Data for each year will be added to a single csv-file eventually)
@@ -731,150 +599,105 @@ df_fut = pd.read_csv(file)
 
 #%%
 
-# Convert strings to datetime format
-for i in range(len(df_fut.index)):
-    df_fut.loc[i,"creation_timestamp"] = dt.datetime.strptime(df_fut.loc[i,"creation_timestamp"], "%Y-%m-%d %H:%M:%S")
-    df_fut.loc[i,"expiration_timestamp"] = dt.datetime.strptime(df_fut.loc[i,"expiration_timestamp"], "%Y-%m-%d %H:%M:%S")
+# Convert strings to datetime format (whole columns at once, as UTC)
+df_fut["creation_timestamp"] = pd.to_datetime(df_fut["creation_timestamp"], utc=True)
+df_fut["expiration_timestamp"] = pd.to_datetime(df_fut["expiration_timestamp"], utc=True)
 
 
 #%%
 
 
 # =============================================================================
-# # A loop that collects all data for each future in a single DataFrame
+# # Download all data for each future (resumable)
 # =============================================================================
 
 # To get data on each future we use a predefined function "get_data(start, end, instrument, tf)"
-# We also use known futures names as well as their creation & expiration timestamps
+# We also use known futures names as well as their creation & expiration timestamps.
+# All resolutions share one journal: running a cell again only downloads what is still missing
 
 
 
 # =============================================================================
-# Get all Data on Futures:    on DAILY BASIS
+# Get all Data on Futures:    on MINUTELY BASIS
 # =============================================================================
 
 
-tf = "1D"
-df_error = []
+tf = "1"
 
-for i in range(len(df_fut.index)):
-    
-    try:
-        
-        start = df_fut.loc[i,"creation_timestamp"]
-        end = df_fut.loc[i,"expiration_timestamp"]
-        print(end)
-        
-        instrument = df_fut.loc[i,"instrument_name"]
-        
-        df_future = get_data(start, end, instrument, tf)
-        
-        # Cut out expiration date from the instrument name to create a directory for that date
-        
-        day = instrument[4:11]
-        df_future.to_csv(r'E:/Futures/Daily/'+ day +'/future-daily_'+ instrument +'.csv')
-        
-    except KeyError:
-        
-        print("Error when collecting data")
-        df_error += [instrument]
+journal = DownloadJournal(r'E:/Futures/downloads.sqlite')
+journal.add(download_units(df_fut, [tf]))
+
+print(run_downloads(journal))
+
+errors = journal.failed()
+errors = errors[errors["resolution"] == tf]
+errors.to_csv(r'E:/Futures/Minutely/errors_minutely.csv', index= False)
 
-        
-errors = pd.Series(df_error)
-errors.to_csv(r'E:/Futures/Daily/errors_daily.csv', index= False)
 
 #%%
 
 # =============================================================================
-# Get all Data on Futures:    on HOURLY BASIS
+# Get all Data on Futures:    on HOURLY and DAILY BASIS
 # =============================================================================
 
+# Derived from the minute candles in the dataset instead of downloading every future two more times
 
-tf = "60"
-df_error = []
+resample_dataset(["60", "1D"], currency="BTC", kind="future")
 
-for i in range(len(df_fut.index)):
-    
-    try:
-        
-        start = df_fut.loc[i,"creation_timestamp"]
-        end = df_fut.loc[i,"expiration_timestamp"]
-        print(end)
-        
-        instrument = df_fut.loc[i,"instrument_name"]
-        
-        df_future = get_data(start, end, instrument, tf)
-        
-        # Cut out expiration date from the instrument name to create a directory for that date
-        
-        day = instrument[4:11]
-        df_future.to_csv(r'E:/Futures/Hourly/future-hourly_'+ instrument +'.csv')
-        
-    except KeyError:
-        
-        print("Error when collecting data")
-        df_error += [instrument]
+# Check on a sample: one future against the candles of the server
 
-        
-errors = pd.Series(df_error)
-errors.to_csv(r'E:/Futures/Hourly/errors_hourly.csv', index= False)
+instrument = df_fut.loc[0, "instrument_name"]
+expiry = df_fut.loc[0, "expiration_timestamp"].strftime('%Y-%m-%d')
 
+df_fut_minutely = read_candles(kind="future", expiry=expiry, tf="1", columns=["timestamp"] + CANDLE_COLUMNS)
+df_fut_minutely = df_fut_minutely.set_index("timestamp").sort_index()
 
+for tf in ["60", "1D"]:
+    print(tf)
+    print(check_resample(df_fut_minutely, instrument, tf, n_samples=3, sample_candles=20))
 
 
 #%%
 
-# =============================================================================
-# Get all Data on Futures:    on MINUTELY BASIS
-# =============================================================================
+# Example: implied volatility and Greeks of the option chain above, priced from the future of the same
+# expiry (or from the perpetual contract if no future expires with the options). Here, after the futures,
+# because it needs the daily candles of that future from resample_dataset
 
+underlying = option_underlying(df_catalog, "2021-03-26")
+add_greeks(chain, underlying_prices(chain, underlying))
 
+df_calls_iv = chain.frame("iv", "call")
+df_puts_delta = chain.frame("delta", "put")
 
-tf = "1"
-df_error = []
 
-for i in range(len(df_fut.index)):
-    
-    try:
-        
-        start = df_fut.loc[i,"creation_timestamp"]
-        end = df_fut.loc[i,"expiration_timestamp"]
-        print(end)
-        
-        instrument = df_fut.loc[i,"instrument_name"]
-        
-        df_future = get_data(start, end, instrument, tf)
-        
-        # Cut out expiration date from the instrument name to create a directory for that date
-        
-        day = instrument[4:11]
-        df_future.to_csv(r'E:/Futures/Minutely/future-minutely_'+ instrument +'.csv')
-        
-    except KeyError:
-        
-        print("Error when collecting data")
-        df_error += [instrument]
-
-        
-errors = pd.Series(df_error)
-errors.to_csv(r'E:/Futures/Minutely/errors_minutely.csv', index= False)
-
-
-
-
-
-
-##########################################################################################
 #%%
 
+# =============================================================================
+# Continuous futures:    front month and next month
+# =============================================================================
 
+# Rolled 7 days before expiration (or roll="volume": when the next contract trades more),
+# earlier prices back-adjusted by the ratio of the closes at every roll
 
+df_contracts = read_contract_candles("1D")
 
+df_front = continuous_futures(df_contracts, df_fut, rank=0, roll="days", roll_days=7, adjust="ratio")
+df_next = continuous_futures(df_contracts, df_fut, rank=1, roll="days", roll_days=7, adjust="ratio")
 
+df_front.to_csv(r'E:/Futures/continuous_front_daily.csv')
+df_next.to_csv(r'E:/Futures/continuous_next_daily.csv')
 
 
+#%%
 
+# =============================================================================
+# Keep the perpetual contract and the active futures current:    live collector
+# =============================================================================
 
+# Runs until interrupted (Ctrl+C); minute candles are appended to E:\Live\<instrument>_1 within seconds,
+# the other resolutions can be derived from them with resample_candles
 
+live_instruments = ["BTC-PERPETUAL"] + df_fut.loc[df_fut["is_active"], "instrument_name"].tolist()
 
-
+collector = LiveCollector(live_instruments, tfs=["1"], trades=True)
+print(collector.run())
@@ -0,0 +1,2906 @@
+# Functions and classes behind deribit.py: API session, downloads, storage and analytics (no cells, so that
+# this module can be imported without running anything)
+
+import asyncio
+import websockets # Can be installed via anaconda environments
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa # Can be installed via anaconda environments
+import pyarrow.compute as pc
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import datetime as dt
+import time
+import itertools
+import bisect
+import logging
+import random
+import collections
+import concurrent.futures
+import sqlite3
+import threading
+import weakref
+import os
+import glob
+import re
+
+logger = logging.getLogger('deribit')
+
+try:
+    import orjson # Optional, parses API responses several times faster (pip install orjson)
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+
+DERIBIT_WS_URL = 'wss://test.deribit.com/ws/api/v2'
+
+# Deribit public (non-matching engine) request credits: every request costs 500 credits,
+# the pool holds up to 50,000 credits and refills with 10,000 credits per second,
+# i.e. bursts of 100 requests and 20 requests per second sustained
+RATE_LIMIT_CREDITS = 50000
+RATE_LIMIT_REFILL = 10000
+REQUEST_COST = 500
+
+# JSON-RPC errors worth retrying (code: Deribit error name); all other errors go to the caller at once.
+# Of these, "too_many_requests" means we are throttled and have to slow down.
+TRANSIENT_ERRORS = {
+    10028: 'too_many_requests',
+    10040: 'retry',
+    10041: 'settlement_in_progress',
+    10047: 'matching_engine_queue_full',
+    11051: 'system_maintenance',
+    11094: 'internal_server_error',
+    13888: 'timed_out',
+}
+THROTTLE_ERRORS = {10028}
+
+# Retries of a request after a transient error or a dropped connection, with jittered exponential
+# backoff (random delay up to BACKOFF_BASE * 2**attempt seconds, at most BACKOFF_CAP)
+MAX_RETRIES = 6
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30
+REQUEST_TIMEOUT = 30
+
+# Requests in flight per session: starts at MAX_CONCURRENCY, grows by one per round of successful
+# requests up to MAX_IN_FLIGHT and halves (at most once per second) when the server throttles us
+MAX_IN_FLIGHT = 32
+
+# Directory of the local candle cache used by get_data
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".deribit", "candles")
+
+# Maximal number of chunk requests that get_data keeps in flight at the same time
+MAX_CONCURRENCY = 8
+
+# Maximal number of candles returned by public/get_tradingview_chart_data in one response
+MAX_CANDLES = 5000
+
+# Candle length of every resolution accepted by public/get_tradingview_chart_data
+RESOLUTIONS = {
+    '1': dt.timedelta(minutes=1),
+    '3': dt.timedelta(minutes=3),
+    '5': dt.timedelta(minutes=5),
+    '10': dt.timedelta(minutes=10),
+    '15': dt.timedelta(minutes=15),
+    '30': dt.timedelta(minutes=30),
+    '60': dt.timedelta(hours=1),
+    '120': dt.timedelta(hours=2),
+    '180': dt.timedelta(hours=3),
+    '360': dt.timedelta(hours=6),
+    '720': dt.timedelta(hours=12),
+    '1D': dt.timedelta(days=1),
+}
+
+
+# Token bucket sized to the request credits above, instead of sleeping a fixed time after each request
+
+class TokenBucket:
+
+    def __init__(self, capacity=RATE_LIMIT_CREDITS, refill_rate=RATE_LIMIT_REFILL, minimum_rate=REQUEST_COST,
+                 decrease=0.5, increase=0.002, interval=1.0):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.maximum_rate = refill_rate
+        self.minimum_rate = minimum_rate
+        self.decrease = decrease
+        self.increase = increase
+        self.interval = interval
+        self.decreased = 0.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()   # the bucket may be shared by event loops in several threads
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    async def acquire(self, cost=REQUEST_COST):
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= cost:
+                    self.tokens -= cost
+                    return
+                wait = (cost - self.tokens) / self.refill_rate
+            await asyncio.sleep(wait)
+
+    # After a "too_many_requests" error the server's credits are used up, whatever our estimate says,
+    # and they come back slower than we assumed: the refill rate is cut (at most once per interval,
+    # like AdaptiveWindow) and grows back by a small step with every request that gets through
+    def drain(self):
+        with self._lock:
+            self._refill()
+            self.tokens = 0
+            now = time.monotonic()
+            if now - self.decreased >= self.interval:
+                self.refill_rate = max(self.minimum_rate, self.refill_rate * self.decrease)
+                self.decreased = now
+
+    def recover(self):
+        with self._lock:
+            self._refill()
+            self.refill_rate = min(self.maximum_rate, self.refill_rate + self.increase * self.maximum_rate)
+
+
+# Error response of the API that is still a failure after all retries
+
+class DeribitError(Exception):
+
+    def __init__(self, code, message, data=None):
+        super().__init__(f'{code} {message}' + (f' ({data})' if data else ''))
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+# A parsed response, or its error raised as a DeribitError
+
+def check_response(res):
+    error = res.get('error')
+    if error is not None:
+        raise DeribitError(error.get('code'), error.get('message'), error.get('data'))
+
+    return res
+
+
+# AIMD window of requests in flight: additive increase while requests succeed,
+# multiplicative decrease when the server throttles
+
+class AdaptiveWindow:
+
+    def __init__(self, initial=MAX_CONCURRENCY, minimum=1, maximum=MAX_IN_FLIGHT, decrease=0.5, interval=1.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.interval = interval
+        self.in_flight = 0
+        self.decreased = 0.0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # Woken up but cancelled before taking the slot: the wakeup goes to the next waiter
+                if waiter.done() and not waiter.cancelled():
+                    self._wake()
+                raise
+        self.in_flight += 1
+
+    def release(self, throttled=False):
+        self.in_flight -= 1
+
+        if throttled:
+            # One throttled burst hits many requests at once; count it as one decrease
+            now = time.monotonic()
+            if now - self.decreased >= self.interval:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+                self.decreased = now
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+        self._wake()
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+def backoff_delay(attempt, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+# =============================================================================
+# Metrics
+# =============================================================================
+
+# Counters, gauges and per-method request latency histograms of the fetch layer. Recording is a
+# few dictionary updates per request; exporters (log line, Prometheus text file, any callback)
+# only run when export() is called, or at most every "interval" seconds through maybe_export().
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+
+    def __init__(self, buckets=LATENCY_BUCKETS, exporters=(), interval=10.0):
+        self.buckets = tuple(buckets)
+        self.exporters = list(exporters)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.monotonic()
+            self.exported = self.started
+            self.requests = {}      # method -> {'count', 'errors', 'bytes', 'seconds', 'histogram'}
+            self.counters = collections.Counter()
+            self.gauges = {}
+
+    # Session observer: one call per request attempt
+    def observe_request(self, method, seconds, n_bytes, error):
+        with self._lock:
+            stats = self.requests.get(method)
+            if stats is None:
+                stats = self.requests[method] = {'count': 0, 'errors': 0, 'bytes': 0, 'seconds': 0.0,
+                                                 'histogram': [0] * (len(self.buckets) + 1)}
+            stats['count'] += 1
+            if error is not None:
+                stats['errors'] += 1
+            if seconds is not None:
+                stats['seconds'] += seconds
+                stats['bytes'] += n_bytes
+                stats['histogram'][bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    # Latency quantile estimated from the histogram (upper bound of the bucket it falls in)
+    def quantile(self, q, method=None):
+        histograms = [stats['histogram'] for m, stats in self.requests.items() if method in (None, m)]
+        if not histograms:
+            return np.nan
+
+        cumulative = np.cumsum(np.sum(histograms, axis=0))
+        if cumulative[-1] == 0:
+            return np.nan
+
+        i = int(np.searchsorted(cumulative, q * cumulative[-1]))
+        return self.buckets[i] if i < len(self.buckets) else np.inf
+
+    def snapshot(self):
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            counters = dict(self.counters)
+            return {
+                'elapsed': elapsed,
+                'requests': {m: dict(stats, histogram=list(stats['histogram'])) for m, stats in self.requests.items()},
+                'counters': counters,
+                'rates': {name + '_per_s': value / elapsed for name, value in counters.items()} if elapsed else {},
+                'gauges': dict(self.gauges),
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': self.buckets,
+            }
+
+    def export(self):
+        snapshot = self.snapshot()
+        self.exported = time.monotonic()
+        for exporter in self.exporters:
+            exporter(snapshot)
+
+    def maybe_export(self):
+        if self.exporters and time.monotonic() - self.exported >= self.interval:
+            self.export()
+
+
+# Exporters: anything called with a snapshot. A plain function works as a callback exporter.
+
+class LogExporter:
+
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def __call__(self, snapshot):
+        requests = sum(stats['count'] for stats in snapshot['requests'].values())
+        errors = sum(stats['errors'] for stats in snapshot['requests'].values())
+        n_bytes = sum(stats['bytes'] for stats in snapshot['requests'].values())
+        fields = [f'requests={requests}', f'errors={errors}', f'mb={n_bytes / 2**20:.1f}',
+                  f'p50_s<={snapshot["p50"]}', f'p99_s<={snapshot["p99"]}']
+        fields += [f'{name}={value}' for name, value in sorted(snapshot['counters'].items())]
+        fields += [f'{name}={value:.1f}' for name, value in sorted(snapshot['rates'].items())]
+        fields += [f'{name}={value}' for name, value in sorted(snapshot['gauges'].items())]
+        self.log.log(self.level, 'metrics ' + ' '.join(fields))
+
+
+# Prometheus text format, written atomically (e.g. for the node_exporter textfile collector)
+
+class PrometheusExporter:
+
+    def __init__(self, path, prefix='deribit'):
+        self.path = path
+        self.prefix = prefix
+
+    def __call__(self, snapshot):
+        p = self.prefix
+        lines = [f'# TYPE {p}_request_seconds histogram']
+        for method, stats in snapshot['requests'].items():
+            cumulative = 0
+            for le, n in zip(list(snapshot['buckets']) + ['+Inf'], stats['histogram']):
+                cumulative += n
+                lines.append(f'{p}_request_seconds_bucket{{method="{method}",le="{le}"}} {cumulative}')
+            lines.append(f'{p}_request_seconds_sum{{method="{method}"}} {stats["seconds"]}')
+            lines.append(f'{p}_request_seconds_count{{method="{method}"}} {cumulative}')
+
+        for name in ['count', 'errors', 'bytes']:
+            lines.append(f'# TYPE {p}_request_{name}_total counter')
+            for method, stats in snapshot['requests'].items():
+                lines.append(f'{p}_request_{name}_total{{method="{method}"}} {stats[name]}')
+
+        for name, value in sorted(snapshot['counters'].items()):
+            lines += [f'# TYPE {p}_{name}_total counter', f'{p}_{name}_total {value}']
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+
+        with open(self.path + '.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+
+metrics = Metrics(exporters=[LogExporter()])
+
+
+# A long-lived session that keeps websocket connections open between calls.
+# Requests get their own JSON-RPC id, so many of them can be in flight on one socket;
+# a reader task per connection hands every response to the request with the same id.
+# Connections belong to the event loop they were opened in, so the session keeps them per loop.
+# Transient errors and dropped connections are retried with backoff, and an AIMD window
+# adapts the number of requests in flight to the throttling observed.
+
+class DeribitSession:
+
+    def __init__(self, url=DERIBIT_WS_URL, n_connections=1, limiter=None, max_retries=MAX_RETRIES,
+                 timeout=REQUEST_TIMEOUT, metrics=metrics):
+        self.url = url
+        self.n_connections = n_connections
+        self.limiter = limiter if limiter is not None else TokenBucket()
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.metrics = metrics
+        # Functions called after every request as observer(method, seconds, n_bytes, error)
+        # (seconds and n_bytes are None if no response arrived)
+        self.observers = [] if metrics is None else [metrics.observe_request]
+        self._ids = itertools.count(1)
+        self._turn = itertools.count()
+        self._loops = weakref.WeakKeyDictionary()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        if loop not in self._loops:
+            self._loops[loop] = {
+                'connections': [],      # list of (websocket, reader task)
+                'pending': {},          # id -> (future, websocket)
+                'connecting': None,
+                'window': AdaptiveWindow(),
+                'url': self.url,        # server of the open connections
+            }
+        return self._loops[loop]
+
+    async def _reader(self, websocket, pending):
+        try:
+            async for response in websocket:
+                res = json_loads(response)
+                future, _ = pending.pop(res.get('id'), (None, None))
+                if future is not None and not future.done():
+                    future.set_result((response, res))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            # Fail every request still waiting on this socket, so that callers don't hang
+            for msg_id, (future, ws) in list(pending.items()):
+                if ws is websocket:
+                    del pending[msg_id]
+                    if not future.done():
+                        future.set_exception(ConnectionError('websocket closed before response ' + str(msg_id)))
+
+    async def _open(self, state):
+        url = self.url
+        websocket = await websockets.connect(url, max_size=None)
+        if url != self.url:
+            await websocket.close()
+            return
+        reader = asyncio.ensure_future(self._reader(websocket, state['pending']))
+        state['connections'].append((websocket, reader))
+
+    async def _connection(self, state):
+        # After connect() to another server, the connections to the previous one are closed
+        if state['url'] != self.url:
+            for websocket, _ in state['connections']:
+                asyncio.ensure_future(websocket.close())
+            state['connections'] = []
+            state['url'] = self.url
+
+        # Drop connections whose reader has stopped (socket closed by the server or the network)
+        state['connections'] = [(ws, reader) for ws, reader in state['connections'] if not reader.done()]
+
+        while len(state['connections']) < self.n_connections:
+            if state['connecting'] is None:
+                state['connecting'] = asyncio.ensure_future(self._open(state))
+            connecting = state['connecting']
+            try:
+                await connecting
+            finally:
+                if state['connecting'] is connecting:
+                    state['connecting'] = None
+
+        websocket, _ = state['connections'][next(self._turn) % len(state['connections'])]
+        return websocket
+
+    async def _call_once(self, msg, state):
+        await self.limiter.acquire()
+        websocket = await self._connection(state)
+
+        msg = dict(msg, id=next(self._ids))
+        future = asyncio.get_running_loop().create_future()
+        state['pending'][msg['id']] = (future, websocket)
+        try:
+            sent = time.perf_counter()
+            await websocket.send(json.dumps(msg))
+            response, res = await asyncio.wait_for(future, self.timeout)
+            self._notify(msg['method'], time.perf_counter() - sent, len(response), res.get('error'))
+            return response, res
+        except websockets.ConnectionClosed:
+            raise ConnectionError('websocket closed before request ' + str(msg['id']))
+        finally:
+            state['pending'].pop(msg['id'], None)
+            # The reader may have failed the future while the request was still being sent
+            if future.done() and not future.cancelled():
+                future.exception()
+
+    # Point the session at another server (e.g. a MockDeribitServer). Every event loop closes its
+    # connections to the previous URL before its next request
+    def connect(self, url):
+        self.url = url
+
+    # Returns the response as a JSON string, or already parsed if parse=True (then an error response
+    # that isn't retried is raised as a DeribitError)
+    async def call(self, msg, parse=False):
+        state = self._state()
+        window = state['window']
+
+        for attempt in range(self.max_retries + 1):
+            throttled = False
+
+            await window.acquire()
+            if self.metrics is not None:
+                self.metrics.gauge('in_flight', window.in_flight)
+            try:
+                response, res = await self._call_once(msg, state)
+            except (ConnectionError, OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                failure = e
+                self._notify(msg['method'], None, None, e)
+            else:
+                error = res.get('error')
+                if error is None or error.get('code') not in TRANSIENT_ERRORS:
+                    self.limiter.recover()
+                    return check_response(res) if parse else response
+
+                throttled = error['code'] in THROTTLE_ERRORS
+                failure = DeribitError(error['code'], error.get('message'), error.get('data'))
+                if throttled:
+                    self.limiter.drain()
+                    if self.metrics is not None:
+                        self.metrics.gauge('refill_rate', self.limiter.refill_rate)
+            finally:
+                window.release(throttled)
+                if self.metrics is not None:
+                    self.metrics.gauge('in_flight', window.in_flight)
+
+            if attempt < self.max_retries:
+                delay = backoff_delay(attempt)
+                logger.warning('%s failed (%r), retrying in %.1f seconds', msg['method'], failure, delay)
+                if self.metrics is not None:
+                    self.metrics.count('retries')
+                await asyncio.sleep(delay)
+
+        raise failure
+
+    def _notify(self, method, seconds, n_bytes, error):
+        for observer in self.observers:
+            observer(method, seconds, n_bytes, error)
+
+    async def close(self):
+        state = self._state()
+        for websocket, reader in state['connections']:
+            await websocket.close()
+            await reader
+        state['connections'] = []
+
+
+session = DeribitSession()
+
+
+async def call_api(msg, parse=False):
+    return await session.call(msg, parse)
+
+
+# Synchronous functions run their coroutine on one background event loop (in its own thread),
+# which keeps the session's connections open between calls and works the same whether or not
+# an event loop is already running in the calling thread (e.g. Spyder or Jupyter)
+
+_background = {'loop': None, 'lock': threading.Lock()}
+
+
+def background_loop():
+    with _background['lock']:
+        if _background['loop'] is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='deribit-loop', daemon=True).start()
+            _background['loop'] = loop
+
+    return _background['loop']
+
+
+def async_loop(api, *args, **kwargs):
+    return asyncio.run_coroutine_threadsafe(api(*args, **kwargs), background_loop()).result()
+
+
+def historic_data_msg(start, end, instrument, timeframe):
+    return \
+        {
+            "jsonrpc": "2.0",
+            "method": "public/get_tradingview_chart_data",
+            "params": {
+                "instrument_name": instrument,
+                "start_timestamp": start,
+                "end_timestamp": end,
+                "resolution": timeframe
+            }
+        }
+
+
+async def retrieve_historic_data_async(start, end, instrument, timeframe):
+    msg = historic_data_msg(start, end, instrument, timeframe)
+    resp = await call_api(msg)
+
+    return resp
+
+
+def retrieve_historic_data(start, end, instrument, timeframe):
+    return async_loop(retrieve_historic_data_async, start, end, instrument, timeframe)
+
+
+# Request several time windows of the same instrument concurrently (at most "concurrency" at a time).
+# Responses (parsed) are returned in the order of the windows, whatever order they arrive in.
+
+async def retrieve_chunks(windows, instrument, timeframe, concurrency=MAX_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(d1, d2):
+        t1 = to_ms(d1)
+        t2 = to_ms(d2)
+
+        async with semaphore:
+            res = await call_api(historic_data_msg(t1, t2, instrument, timeframe), parse=True)
+
+        logger.debug('collected data for dates: %s to %s', d1.isoformat(), d2.isoformat())
+        return res
+
+    return await asyncio.gather(*[fetch(d1, d2) for d1, d2 in windows])
+
+
+# Convert a column of integer milliseconds since UNIX epoch into tz-aware (UTC) datetime64 in one step
+
+def ms_to_datetime(ms):
+    return pd.to_datetime(np.asarray(ms).astype('int64'), unit='ms', utc=True)
+
+
+# Convert Json to DataFrame
+
+def json_to_dataframe(json_resp):
+    res = json_loads(json_resp)
+
+    # Ranges without any candles come back as {"status": "no_data"} and give an empty DataFrame
+    candles = CandleAccumulator(capacity=len(res['result'].get('ticks', [])))
+    candles.add(res['result'])
+
+    df = candles.to_dataframe()
+    df['ticks'] = candles.ticks / 1000
+
+    return df
+
+
+# Columnar accumulator for candle chunks: copies the parallel arrays of every response straight into
+# one preallocated NumPy buffer per column (grown by doubling if needed) and builds the DataFrame once
+# at the end, instead of copying everything collected so far on every chunk
+
+CANDLE_COLUMNS = ['volume', 'cost', 'open', 'low', 'high', 'close']
+
+
+class CandleAccumulator:
+
+    def __init__(self, columns=CANDLE_COLUMNS, capacity=MAX_CANDLES):
+        self.columns = list(columns)
+        self._buffers = {'ticks': np.empty(capacity, dtype='int64')}
+        for col in self.columns:
+            self._buffers[col] = np.empty(capacity, dtype='float64')
+        self.n_rows = 0
+
+    def _reserve(self, n):
+        capacity = len(self._buffers['ticks'])
+        if self.n_rows + n <= capacity:
+            return
+
+        capacity = max(2 * capacity, self.n_rows + n)
+        for col, buffer in self._buffers.items():
+            grown = np.empty(capacity, dtype=buffer.dtype)
+            grown[:self.n_rows] = buffer[:self.n_rows]
+            self._buffers[col] = grown
+
+    def add(self, result):
+        # Responses with "status": "no_data" carry no candles
+        if result.get('status') == 'no_data':
+            return
+
+        n = len(result['ticks'])
+        self._reserve(n)
+        for col, buffer in self._buffers.items():
+            buffer[self.n_rows:self.n_rows + n] = result[col]
+        self.n_rows += n
+
+    @property
+    def ticks(self):
+        return self._buffers['ticks'][:self.n_rows]
+
+    def to_dataframe(self):
+        df = pd.DataFrame({col: self._buffers[col][:self.n_rows] for col in self.columns})
+        df['timestamp'] = ms_to_datetime(self.ticks)
+
+        return df
+
+
+# Chunk planner: size every request window so that it returns up to "max_candles" candles.
+# Both ends of a window are inclusive, so a window spans (max_candles - 1) candle lengths.
+
+def chunk_window(tf, max_candles=MAX_CANDLES):
+    return RESOLUTIONS[str(tf)] * (max_candles - 1)
+
+
+def plan_chunks(date1, date2, tf, max_candles=MAX_CANDLES, window=None):
+    if window is None:
+        window = chunk_window(tf, max_candles)
+
+    # Both ends are inclusive, so a range of one candle is one window
+    if date1 == date2:
+        return [(date1, date2)]
+
+    windows = []
+    d1 = date1
+    while d1 < date2:
+        d2 = min(d1 + window, date2)
+        windows.append((d1, d2))
+        d1 = d2
+
+    return windows
+
+
+# Local candle cache: per (instrument, resolution) a directory with the candles collected so far and the
+# time ranges (milliseconds) that were already requested from the API (covered.json). The candles are kept
+# in Parquet files of CACHE_BLOCK candle lengths each, so that a range is read, and an update written,
+# without loading the whole series.
+# Only candles that were complete when they were fetched count as covered; those never change,
+# so expired instruments are served from disk entirely and active ones only refresh their tail.
+
+CACHE_BLOCK = 50000
+
+def merge_intervals(intervals):
+    merged = []
+    for t1, t2 in sorted(intervals):
+        if merged and t1 <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], t2))
+        else:
+            merged.append((t1, t2))
+
+    return merged
+
+
+def missing_intervals(covered, t1, t2):
+    gaps = []
+    cursor = t1
+    for c1, c2 in covered:
+        if c2 <= cursor:
+            continue
+        if c1 >= t2:
+            break
+        if c1 > cursor:
+            gaps.append((cursor, c1))
+        cursor = max(cursor, c2)
+
+    if cursor < t2:
+        gaps.append((cursor, t2))
+
+    return gaps
+
+
+class CandleCache:
+
+    def __init__(self, directory=CACHE_DIR, block=CACHE_BLOCK):
+        self.directory = directory
+        self.block = block
+
+    def path(self, instrument, tf):
+        return os.path.join(self.directory, f'{instrument}_{tf}')
+
+    def _span(self, tf):
+        return self.block * (RESOLUTIONS[str(tf)] // dt.timedelta(milliseconds=1))
+
+    def covered(self, instrument, tf):
+        self._convert(instrument, tf)
+        path = os.path.join(self.path(instrument, tf), 'covered.json')
+        if not os.path.exists(path):
+            return []
+
+        with open(path) as f:
+            return [tuple(interval) for interval in json.load(f)]
+
+    # Cached candles between t1 and t2 (milliseconds, both included; None: open end), read from the
+    # blocks of that range only
+    def load(self, instrument, tf, t1=None, t2=None):
+        self._convert(instrument, tf)
+        directory = self.path(instrument, tf)
+        span = self._span(tf)
+
+        blocks = sorted(int(name[:-len('.parquet')]) for name in os.listdir(directory) if name.endswith('.parquet')) \
+            if os.path.isdir(directory) else []
+        frames = [pd.read_parquet(os.path.join(directory, f'{k}.parquet')) for k in blocks
+                  if (t1 is None or (k + 1) * span > t1) and (t2 is None or k * span <= t2)]
+        if not frames:
+            return pd.DataFrame(columns=CANDLE_COLUMNS, index=pd.DatetimeIndex([], tz='UTC', name='timestamp'),
+                                dtype='float64')
+
+        df = pd.concat(frames)
+        return df.loc[None if t1 is None else pd.Timestamp(t1, unit='ms', tz='UTC'):
+                      None if t2 is None else pd.Timestamp(t2, unit='ms', tz='UTC')]
+
+    def missing(self, instrument, tf, t1, t2):
+        return missing_intervals(self.covered(instrument, tf), t1, t2)
+
+    def update(self, instrument, tf, df_new, fetched):
+        covered = self.covered(instrument, tf)
+
+        # The candle that is still being formed must be fetched again next time
+        complete = time.time() * 1000 - RESOLUTIONS[str(tf)].total_seconds() * 1000
+        covered = merge_intervals(covered + [(t1, min(t2, complete)) for t1, t2 in fetched if t1 < complete])
+
+        self._write(instrument, tf, df_new, covered)
+
+    # Only the blocks that get new candles are rewritten, then the covered ranges
+    def _write(self, instrument, tf, df_new, covered):
+        directory = self.path(instrument, tf)
+        os.makedirs(directory, exist_ok=True)
+
+        ticks = (df_new.index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+        blocks = np.asarray(ticks, dtype='int64') // self._span(tf)
+        for k in np.unique(blocks):
+            df = df_new[blocks == k]
+            path = os.path.join(directory, f'{k}.parquet')
+            if os.path.exists(path):
+                df = pd.concat([pd.read_parquet(path), df])
+                df = df[~df.index.duplicated(keep='last')]
+            df.sort_index().to_parquet(path + '.tmp')
+            os.replace(path + '.tmp', path)
+
+        path = os.path.join(directory, 'covered.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(covered, f)
+        os.replace(path + '.tmp', path)
+
+    # Caches of earlier versions (one pickle per instrument and resolution) are converted on first use
+    def _convert(self, instrument, tf):
+        path = os.path.join(self.directory, f'{instrument}_{tf}.pkl')
+        if os.path.exists(path):
+            entry = pd.read_pickle(path)
+            self._write(instrument, tf, entry['candles'], entry['covered'])
+            os.remove(path)
+
+
+candle_cache = CandleCache()
+
+
+# Define a function to get data on a certain instrument using its name and 2 timestamps, between which this instrument was traded.
+# get_data_async can be awaited (and gathered) from an asyncio application; get_data is the same for scripts
+
+async def get_data_async(date1, date2, instrument, tf='1', concurrency=MAX_CONCURRENCY, max_candles=MAX_CANDLES,
+                         window=None, cache=candle_cache):
+    
+    # Collect data in windows sized to the resolution (e.g. ~3.5 days for "1", ~13.7 years for "1D");
+    # "window" (a dt.timedelta) overrides the planner, e.g. window=dt.timedelta(days=1) for daily steps.
+    # Only the parts of the range missing from the cache are requested; cache=None always downloads everything
+    
+    # Assumption: Both dates between which the data is collected are saved/given in datetime.datetime format
+    # (naive ones in UTC, see to_utc)
+    t1 = to_ms(date1)
+    t2 = to_ms(date2)
+
+    gaps = cache.missing(instrument, tf, t1, t2) if cache is not None else [(t1, t2)]
+
+    windows = [w for g1, g2 in gaps
+               for w in plan_chunks(pd.Timestamp(g1, unit='ms', tz='UTC'), pd.Timestamp(g2, unit='ms', tz='UTC'),
+                                    tf, max_candles, window)]
+
+    # Room for the largest possible result (the candles of every window, at most max_candles each),
+    # so that the candles are copied into place only once
+    width = RESOLUTIONS[str(tf)]
+    candles = CandleAccumulator(capacity=sum(min(max_candles, (d2 - d1) // width + 1) for d1, d2 in windows))
+
+    # Fetch all windows concurrently; the session's token bucket keeps us within the rate limit
+    responses = await retrieve_chunks(windows, instrument, tf, concurrency)
+
+    for res in responses:
+        candles.add(res['result'])
+
+    metrics.count('candles', candles.n_rows)
+    metrics.maybe_export()
+
+    # Build the DataFrame once (columns: volume, cost, open, low, high, close, timestamp)
+    df_complete = candles.to_dataframe()
+
+    # Filter out duplicates
+    df_complete.drop_duplicates(subset=['timestamp'],
+                                keep='first',
+                                inplace=True)
+
+    # Set timestamps as index (sorted, since chunks may overlap at their borders)
+    df_complete = df_complete.set_index("timestamp").sort_index()
+
+    # Merge the new candles into the cached series and return the requested range
+    if cache is not None:
+        cache.update(instrument, tf, df_complete, gaps)
+        df_complete = cache.load(instrument, tf, t1, t2)
+    
+    # If you don't want to set timestamps as index, just reset the index
+    # df_filtered.reset_index(inplace=True)    
+        
+    return df_complete
+
+
+def get_data(date1, date2, instrument, tf='1', concurrency=MAX_CONCURRENCY, max_candles=MAX_CANDLES, window=None,
+             cache=candle_cache):
+    return async_loop(get_data_async, date1, date2, instrument, tf, concurrency, max_candles, window, cache)
+
+
+# =============================================================================
+# Instruments: metadata of one instrument
+# =============================================================================
+
+# Function to retrieve various information about a certain instrument (of main importance: creation & expiration dates)
+
+async def get_instrument_async(instrument): 
+    msg = \
+        {
+                "method" : "public/get_instrument",
+                "params" : {
+                        "instrument_name" : instrument
+                        },
+                        "jsonrpc" : "2.0"
+                }                   
+    resp = await call_api(msg)
+
+    return resp
+
+
+def get_instrument(instrument):
+    return async_loop(get_instrument_async, instrument)
+
+
+def json_to_datafr(json_resp):
+    res = json_loads(json_resp)
+
+    # Unknown instruments come back as an error
+    check_response(res)
+    
+    # Simple indexing of a DataFrame to prevent ValueError
+    df = pd.DataFrame(res['result'], index = [0])
+    
+    return df
+
+
+# Memoized instrument metadata in front of get_instrument. Expired instruments never change and are kept
+# for good, active ones are looked up again after "ttl" seconds. Entries are stored in a SQLite file, so
+# they survive restarts, and identical lookups running at the same time share a single request
+
+INSTRUMENT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".deribit", "instruments.sqlite")
+INSTRUMENT_TTL = 3600
+
+
+class InstrumentCache:
+
+    def __init__(self, path=INSTRUMENT_CACHE_PATH, ttl=INSTRUMENT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}       # instrument -> (result, fetched, expired)
+        self.pending = {}       # instrument -> future of the lookup in flight
+        self.db = None
+        self._lock = threading.Lock()
+
+    # The file is only created by the first lookup
+    def _db(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS instruments (
+                    instrument_name TEXT PRIMARY KEY,
+                    result TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    expired INTEGER NOT NULL
+                )""")
+            self.db.commit()
+        return self.db
+
+    def fresh(self, entry):
+        return entry is not None and (entry[2] or time.time() - entry[1] < self.ttl)
+
+    def lookup(self, instrument):
+        entry = self.entries.get(instrument)
+        if entry is None:
+            with self._lock:
+                row = self._db().execute("SELECT result, fetched, expired FROM instruments WHERE instrument_name = ?",
+                                         (instrument,)).fetchone()
+            if row is not None:
+                entry = self.entries[instrument] = (json_loads(row[0]), row[1], bool(row[2]))
+
+        return entry if self.fresh(entry) else None
+
+    def store(self, instrument, result):
+        fetched = time.time()
+        expired = result.get('expiration_timestamp', float('inf')) <= fetched * 1000 or result.get('is_active') is False
+        self.entries[instrument] = (result, fetched, expired)
+
+        with self._lock:
+            self._db().execute("INSERT OR REPLACE INTO instruments VALUES (?, ?, ?, ?)",
+                               (instrument, json.dumps(result), fetched, int(expired)))
+            self.db.commit()
+
+    async def fetch(self, instrument):
+        try:
+            res = check_response(json_loads(await get_instrument_async(instrument)))
+
+            # Failures are not cached: the next lookup asks the API again
+            self.store(instrument, res['result'])
+            return res['result']
+        finally:
+            if self.pending.get(instrument) is asyncio.current_task():
+                del self.pending[instrument]
+
+    # Metadata ("result" of public/get_instrument) as a dict. The request runs as a task of its own,
+    # which every caller waiting for the same instrument awaits (cancelling one of them doesn't cancel it)
+    async def get_async(self, instrument):
+        entry = self.lookup(instrument)
+        if entry is not None:
+            metrics.count('instrument_cache_hits')
+            return entry[0]
+
+        task = self.pending.get(instrument)
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            metrics.count('instrument_lookups_coalesced')
+        else:
+            metrics.count('instrument_cache_misses')
+            task = self.pending[instrument] = asyncio.ensure_future(self.fetch(instrument))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+        return await asyncio.shield(task)
+
+    def get(self, instrument):
+        return async_loop(self.get_async, instrument)
+
+    # Forget one instrument (or all), in memory and on disk
+    def invalidate(self, instrument=None):
+        with self._lock:
+            if instrument is None:
+                self.entries.clear()
+                self._db().execute("DELETE FROM instruments")
+            else:
+                self.entries.pop(instrument, None)
+                self._db().execute("DELETE FROM instruments WHERE instrument_name = ?", (instrument,))
+            self.db.commit()
+
+
+instrument_cache = InstrumentCache()
+
+
+# cache=None always asks the API
+
+async def instrument_info_async(instrument, cache=instrument_cache):
+    if cache is None:
+        json_inst = await get_instrument_async(instrument)
+        return json_to_datafr(json_inst)
+
+    df_inst = pd.DataFrame(await cache.get_async(instrument), index=[0])
+    
+    return df_inst
+
+
+def instrument_info(instrument, cache=instrument_cache):
+    return async_loop(instrument_info_async, instrument, cache)
+
+
+# Adjust of the resulting DataFrame for further computations (Definition)
+
+def adjust_df(df):
+    
+    # Reset index from 0s
+    df = df.reset_index()
+    
+    # Change timestamps (milliseconds) to datetime format (UTC)
+    df["creation_timestamp"] = ms_to_datetime(df["creation_timestamp"])
+    df["expiration_timestamp"] = ms_to_datetime(df["expiration_timestamp"])
+    
+    # Drop an additional index column
+    df = df.drop(['index'], axis=1)
+    
+    return df
+
+
+# =============================================================================
+#  Instrument catalog: all previously and currently existing instruments (names, creation/expiration timestamps)
+# =============================================================================
+
+# "public/get_instruments" lists all instruments of one currency and kind in a single response
+# (with "expired": True the expired ones), so the whole catalog takes a few requests
+# instead of probing every possible combination of expiration date, strike price and option art
+
+# The catalog is indexed by kind, expiration and name, so that e.g. all options of a year are one slice
+CATALOG_INDEX = ['kind', 'expiration_timestamp', 'instrument_name']
+
+
+def instruments_msg(currency, kind, expired=False):
+    return \
+        {
+            "jsonrpc": "2.0",
+            "method": "public/get_instruments",
+            "params": {
+                "currency": currency,
+                "kind": kind,
+                "expired": expired
+            }
+        }
+
+
+def get_instruments(currency, kind, expired=False):
+    msg = instruments_msg(currency, kind, expired)
+    resp = async_loop(call_api, msg)
+
+    return resp
+
+
+async def retrieve_instruments(currencies, kinds):
+    msgs = [instruments_msg(currency, kind, expired)
+            for currency in currencies for kind in kinds for expired in [False, True]]
+
+    return await asyncio.gather(*[call_api(msg) for msg in msgs])
+
+
+def instrument_catalog(currencies=("BTC",), kinds=("option", "future")):
+    json_resps = async_loop(retrieve_instruments, currencies, kinds)
+
+    frames = [pd.DataFrame(json_loads(json_resp)['result']) for json_resp in json_resps]
+    df = pd.concat([frame for frame in frames if len(frame)], ignore_index=True)
+    df = df.drop_duplicates(subset=['instrument_name'])
+
+    return adjust_df(df).set_index(CATALOG_INDEX).sort_index()
+
+
+# Instruments of one kind, optionally only those expiring between "start" and "end" (e.g. "2021", "2021")
+
+def select_instruments(catalog, kind, start=None, end=None):
+    by_expiration = catalog.loc[[kind]].reset_index(["kind", "instrument_name"])
+
+    return by_expiration.loc[start:end].reset_index()
+
+
+def save_catalog(catalog, path):
+    catalog.to_csv(path)
+
+
+def load_catalog(path):
+    df = pd.read_csv(path)
+
+    df["creation_timestamp"] = pd.to_datetime(df["creation_timestamp"], utc=True)
+    df["expiration_timestamp"] = pd.to_datetime(df["expiration_timestamp"], utc=True)
+
+    return df.set_index(CATALOG_INDEX).sort_index()
+
+
+# =============================================================================
+# Instrument names: parser and expiry/strike index
+# =============================================================================
+
+# Deribit names are <CURRENCY>-PERPETUAL, <CURRENCY>-<DMMMYY> (futures) and <CURRENCY>-<DMMMYY>-<STRIKE>-<C|P>
+# (options), where the day has one or two digits, the currency may be e.g. "ETH" or "SOL_USDC", and
+# decimal strikes are written with a "d" ("0d625"). Futures and options expire at 08:00 UTC.
+
+INSTRUMENT_PATTERN = (r'^(?P<currency>[A-Z0-9_]+)-(?:(?P<perpetual>PERPETUAL)|'
+                      r'(?P<day>\d{1,2})(?P<month>[A-Z]{3})(?P<year>\d{2})(?:-(?P<strike>[0-9d.]+)-(?P<type>[CP]))?)$')
+
+MONTHS = ['JAN', 'FEB', 'MAR', 'APR', 'MAY', 'JUN', 'JUL', 'AUG', 'SEP', 'OCT', 'NOV', 'DEC']
+MONTH_NUMBERS = {month: i + 1 for i, month in enumerate(MONTHS)}
+
+
+# Typed columns of a sequence of names, in one pass of a regular expression over all of them:
+# currency, kind ("future" or "option", None if not a name of the formats above),
+# expiration_timestamp (UTC, NaT for perpetual contracts), strike and option_type ("call" or "put")
+
+def parse_instruments(names):
+    names = pd.Series(np.asarray(names, dtype=object), name='instrument_name')
+    parts = names.str.extract(INSTRUMENT_PATTERN)
+
+    dated = parts['day'].notna()
+    date = pd.to_datetime(pd.DataFrame({'year': 2000 + pd.to_numeric(parts['year'][dated]),
+                                        'month': parts['month'][dated].map(MONTH_NUMBERS),
+                                        'day': pd.to_numeric(parts['day'][dated])}), errors='coerce')
+
+    df = pd.DataFrame({'instrument_name': names, 'currency': parts['currency']})
+    df['kind'] = np.where(parts['type'].notna(), 'option', np.where(parts['currency'].notna(), 'future', None))
+    df['expiration_timestamp'] = (date + OPTION_EXPIRY_TIME).dt.tz_localize('UTC').reindex(df.index)
+    df['strike'] = pd.to_numeric(parts['strike'].str.replace('d', '.', regex=False))
+    df['option_type'] = parts['type'].map({'C': 'call', 'P': 'put'})
+
+    return df
+
+
+# An expiry as a date: "26MAR21", "2021-03-26" or anything pd.Timestamp accepts
+
+def parse_expiry(expiry):
+    if isinstance(expiry, str):
+        match = re.fullmatch(r'(\d{1,2})([A-Z]{3})(\d{2})', expiry.upper())
+        if match:
+            return pd.Timestamp(2000 + int(match[3]), MONTH_NUMBERS[match[2]], int(match[1]))
+
+    expiry = pd.Timestamp(expiry)
+    return (expiry.tz_convert('UTC').tz_localize(None) if expiry.tzinfo else expiry).normalize()
+
+
+# Sorted index over instruments (a catalog DataFrame with an instrument_name column, or just names):
+# ordered by kind, option type, expiration date and strike, so that e.g. all puts of one expiry are a
+# contiguous block found by binary search, and a strike range within it another binary search
+
+class InstrumentIndex:
+
+    KINDS = {'future': 0, 'option': 1}
+    OPTION_TYPES = {None: 0, 'call': 1, 'put': 2}
+
+    def __init__(self, instruments):
+        if not isinstance(instruments, pd.DataFrame):
+            instruments = pd.DataFrame({'instrument_name': list(instruments)})
+
+        parsed = parse_instruments(instruments['instrument_name'])
+        instruments = instruments.reset_index(drop=True)
+        for col in parsed.columns:
+            if col not in instruments.columns:
+                instruments[col] = parsed[col]
+
+        # Group of every instrument (kind, option type, expiration day) as one integer, -1 for unknown names
+        days = parsed['expiration_timestamp'].dt.tz_localize(None).dt.normalize()
+        days = ((days - pd.Timestamp(0)) // pd.Timedelta(days=1)).fillna(-1).to_numpy('int64')
+        groups = self.group(parsed['kind'].map(self.KINDS).fillna(-1).to_numpy('int64'),
+                            parsed['option_type'].map(self.OPTION_TYPES).fillna(0).to_numpy('int64'), days)
+        strikes = parsed['strike'].fillna(0.0).to_numpy()
+
+        order = np.lexsort((strikes, groups))
+        self.instruments = instruments.iloc[order].reset_index(drop=True)
+        self.groups = groups[order]
+        self.strikes = strikes[order]
+
+    @staticmethod
+    def group(kind, option_type, days):
+        return (kind * 4 + option_type) * 2**40 + days + 1
+
+    def __len__(self):
+        return len(self.groups)
+
+    # Rows (positions) of the instruments of one kind and option type, of one expiry (or all)
+    def _block(self, kind, option_type, expiry):
+        kind = self.KINDS[kind]
+        option_type = self.OPTION_TYPES[option_type]
+        if expiry is None:
+            lo, hi = self.group(kind, option_type, -1), self.group(kind, option_type, 2**40 - 2)
+        else:
+            lo = hi = self.group(kind, option_type, (parse_expiry(expiry) - pd.Timestamp(0)) // pd.Timedelta(days=1))
+
+        return int(np.searchsorted(self.groups, lo, 'left')), int(np.searchsorted(self.groups, hi, 'right'))
+
+    # e.g. select(option_type="put", expiry="26MAR21", strike_min=30000, strike_max=40000);
+    # option_type=None selects calls and puts (kind "option") or the futures (kind "future")
+    def select(self, kind='option', option_type=None, expiry=None, strike_min=None, strike_max=None, currency=None):
+        types = [option_type] if option_type is not None or kind == 'future' else ['call', 'put']
+
+        positions = []
+        for t in types:
+            i, j = self._block(kind, t, expiry)
+            strikes = self.strikes[i:j]
+            if expiry is not None:
+                # One expiry: the strikes of the block are sorted
+                a = i if strike_min is None else i + int(np.searchsorted(strikes, strike_min, 'left'))
+                b = j if strike_max is None else i + int(np.searchsorted(strikes, strike_max, 'right'))
+                positions.append(np.arange(a, b))
+            else:
+                keep = np.ones(j - i, dtype=bool)
+                if strike_min is not None:
+                    keep &= strikes >= strike_min
+                if strike_max is not None:
+                    keep &= strikes <= strike_max
+                positions.append(i + np.flatnonzero(keep))
+
+        df = self.instruments.iloc[np.concatenate(positions)]
+        return df if currency is None else df[df['currency'] == currency]
+
+    # Expiration dates (sorted) of one kind
+    def expiries(self, kind='option'):
+        return sorted(self.instruments.loc[self.instruments['kind'] == kind, 'expiration_timestamp'].dropna().unique())
+
+
+# =============================================================================
+# Storage: partitioned Parquet dataset
+# =============================================================================
+
+# Candles are stored as one Parquet file per instrument in hive-style partitions:
+#   <root>/currency=BTC/kind=option/expiry=2021-03-26/resolution=1D/BTC-26MAR21-36000-P.parquet
+# so that a whole option chain (one expiry) is a single directory, and reads can skip
+# partitions, columns and (via Parquet statistics) files that don't match time or strike filters
+
+# Change here the root directory of the dataset
+STORE_DIR = r'E:\Store'
+
+STORE_PARTITIONS = pa.schema([
+    ('currency', pa.string()),
+    ('kind', pa.string()),
+    ('expiry', pa.string()),
+    ('resolution', pa.string()),
+])
+
+CANDLE_SCHEMA = pa.schema([
+    ('timestamp', pa.timestamp('ms', tz='UTC')),
+    ('instrument_name', pa.string()),
+    ('strike', pa.float64()),
+    ('option_type', pa.string()),
+    ('open', pa.float64()),
+    ('high', pa.float64()),
+    ('low', pa.float64()),
+    ('close', pa.float64()),
+    ('volume', pa.float64()),
+    ('cost', pa.float64()),
+])
+
+
+# Naive datetimes are taken as UTC everywhere (get_data, iter_candles, the trades, the dataset and the
+# memory-mapped series), like the timestamps they return; tz-aware ones are converted
+
+def to_utc(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_localize('UTC') if timestamp.tzinfo is None else timestamp.tz_convert('UTC')
+
+
+def partition_dir(root, currency, kind, expiry, tf):
+    return os.path.join(root, f'currency={currency}', f'kind={kind}', f'expiry={expiry}', f'resolution={tf}')
+
+
+# Write the result of get_data for one instrument (replaces an earlier file of the same instrument).
+# "expiry" is the expiration date as "YYYY-MM-DD" ("perpetual" for perpetual contracts)
+
+def candles_table(df, instrument, strike=None, option_type=None):
+    df = df.reset_index()
+
+    df['instrument_name'] = instrument
+    df['strike'] = np.nan if strike is None else float(strike)
+    df['option_type'] = option_type
+
+    return pa.Table.from_pandas(df[CANDLE_SCHEMA.names], schema=CANDLE_SCHEMA, preserve_index=False)
+
+
+def write_candles(df, instrument, tf, currency, kind, expiry, strike=None, option_type=None, root=STORE_DIR):
+    table = candles_table(df, instrument, strike, option_type)
+
+    directory = partition_dir(root, currency, kind, expiry, tf)
+    os.makedirs(directory, exist_ok=True)
+    pq.write_table(table, os.path.join(directory, instrument + '.parquet'))
+
+
+# Same, with the partition values taken from an instrument row of the catalog (see adjust_df)
+
+def write_instrument_candles(df, info, tf, root=STORE_DIR):
+    strike = info.get('strike')
+    option_type = info.get('option_type')
+
+    write_candles(df, info['instrument_name'], tf,
+                  currency=info['base_currency'],
+                  kind=info['kind'],
+                  expiry=info['expiration_timestamp'].strftime('%Y-%m-%d'),
+                  strike=None if pd.isna(strike) else strike,
+                  option_type=None if pd.isna(option_type) else option_type,
+                  root=root)
+
+
+# Read candles from the dataset. Only the given columns are read (None: all), and the filters
+# are pushed down to the dataset scan: partitions first, then time and strike per file
+
+def read_candles(root=STORE_DIR, columns=None, currency=None, kind=None, expiry=None, tf=None,
+                 start=None, end=None, strike_min=None, strike_max=None, option_type=None):
+    dataset = ds.dataset(root, format='parquet', schema=pa.unify_schemas([CANDLE_SCHEMA, STORE_PARTITIONS]),
+                         partitioning=ds.partitioning(STORE_PARTITIONS, flavor='hive'))
+
+    conditions = []
+    for name, value in [('currency', currency), ('kind', kind), ('expiry', expiry),
+                        ('resolution', tf), ('option_type', option_type)]:
+        if value is not None:
+            conditions.append(ds.field(name) == value)
+
+    timestamp = CANDLE_SCHEMA.field('timestamp').type
+    if start is not None:
+        conditions.append(ds.field('timestamp') >= pa.scalar(to_utc(start), timestamp))
+    if end is not None:
+        conditions.append(ds.field('timestamp') <= pa.scalar(to_utc(end), timestamp))
+    if strike_min is not None:
+        conditions.append(ds.field('strike') >= strike_min)
+    if strike_max is not None:
+        conditions.append(ds.field('strike') <= strike_max)
+
+    condition = None
+    for c in conditions:
+        condition = c if condition is None else condition & c
+
+    return dataset.to_table(columns=columns, filter=condition).to_pandas()
+
+
+
+# =============================================================================
+# Storage: memory-mapped minute series
+# =============================================================================
+
+# A series is a directory with one raw little-endian file per column (e.g. "close.f8"), all of the
+# same length and sorted by ticks. Reading maps the files with numpy.memmap, so a time slice is a
+# view found by binary search on ticks: nothing is copied, and processes reading the same series
+# share it through the page cache
+
+MEMMAP_COLUMNS = {
+    'ticks': '<i8',     # milliseconds since UNIX epoch
+    'open': '<f8',
+    'high': '<f8',
+    'low': '<f8',
+    'close': '<f8',
+    'volume': '<f8',
+    'cost': '<f8',
+}
+
+
+def to_ms(timestamp):
+    return int(to_utc(timestamp).timestamp() * 1000)
+
+
+# Write the result of get_data (timestamp index) as a memory-mappable series
+
+def write_memmap(df, directory):
+    os.makedirs(directory, exist_ok=True)
+
+    df = df.sort_index()
+    data = {'ticks': (df.index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)}
+    for col in MEMMAP_COLUMNS:
+        if col != 'ticks':
+            data[col] = df[col]
+
+    for col, dtype in MEMMAP_COLUMNS.items():
+        path = os.path.join(directory, col + '.' + dtype[1:])
+        np.asarray(data[col], dtype=dtype).tofile(path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+
+# "columns" is the layout of the files (MEMMAP_COLUMNS for candles, TRADE_COLUMNS for trades)
+
+class MemmapSeries:
+
+    def __init__(self, directory, columns=MEMMAP_COLUMNS):
+        self.directory = directory
+        self.columns = {}
+        for col, dtype in columns.items():
+            path = os.path.join(directory, col + '.' + dtype[1:])
+            # numpy.memmap can't map an empty file
+            if os.path.getsize(path) == 0:
+                self.columns[col] = np.empty(0, dtype=dtype)
+            else:
+                self.columns[col] = np.memmap(path, dtype=dtype, mode='r')
+
+        self.ticks = self.columns['ticks']
+
+    def __len__(self):
+        return len(self.ticks)
+
+    # Row positions of the candles between start and end (both inclusive)
+    def bounds(self, start=None, end=None):
+        i = 0 if start is None else int(np.searchsorted(self.ticks, to_ms(start), side='left'))
+        j = len(self.ticks) if end is None else int(np.searchsorted(self.ticks, to_ms(end), side='right'))
+        return i, j
+
+    # Zero-copy views of all columns between start and end
+    def slice(self, start=None, end=None):
+        i, j = self.bounds(start, end)
+        return {col: values[i:j] for col, values in self.columns.items()}
+
+    # Copy of a slice as a DataFrame (candles in the format of get_data)
+    def to_dataframe(self, start=None, end=None):
+        views = self.slice(start, end)
+
+        names = [col for col in CANDLE_COLUMNS if col in views] + [col for col in views if col not in MEMMAP_COLUMNS]
+        df = pd.DataFrame({col: np.array(views[col]) for col in names})
+        df.index = pd.Index(ms_to_datetime(views['ticks']), name='timestamp')
+
+        return df
+
+
+
+# =============================================================================
+# Streaming: chunks of candles written to disk as they arrive
+# =============================================================================
+
+# iter_candles yields the candles of a range chunk by chunk, in time order, in the format of get_data.
+# At most "concurrency" chunks are requested ahead of the one being yielded, so memory stays the same
+# however long the range is. As in get_data, the parts of the range covered by the candle cache (e.g.
+# after import_legacy) are read from it window by window and only the gaps are requested; the requested
+# windows are added to the cache (cache=None always downloads everything)
+
+async def iter_candles_async(date1, date2, instrument, tf='1', concurrency=MAX_CONCURRENCY, max_candles=MAX_CANDLES,
+                             cache=candle_cache):
+    t1 = to_ms(date1)
+    t2 = to_ms(date2)
+
+    covered = cache.covered(instrument, tf) if cache is not None else []
+    gaps = missing_intervals(covered, t1, t2)
+
+    # Windows of the range in time order, each with whether it is requested (or read from the cache)
+    parts = collections.deque()
+    segments = [(g1, g2, True) for g1, g2 in gaps] + \
+               [(max(c1, t1), min(c2, t2), False) for c1, c2 in covered if c1 <= t2 and c2 >= t1]
+
+    for s1, s2, gap in sorted(segments):
+        d1, d2 = pd.Timestamp(s1, unit='ms', tz='UTC'), pd.Timestamp(s2, unit='ms', tz='UTC')
+        parts.extend((w, gap) for w in plan_chunks(d1, d2, tf, max_candles))
+
+    windows = collections.deque(w for w, gap in parts if gap)
+    in_flight = collections.deque()
+    last = None
+
+    try:
+        while parts:
+            while windows and len(in_flight) < concurrency:
+                d1, d2 = windows.popleft()
+                msg = historic_data_msg(to_ms(d1), to_ms(d2), instrument, tf)
+                in_flight.append(asyncio.ensure_future(call_api(msg, parse=True)))
+
+            (d1, d2), gap = parts.popleft()
+            if gap:
+                candles = CandleAccumulator(capacity=max_candles)
+                candles.add((await in_flight.popleft())['result'])
+                chunk = candles.to_dataframe().set_index("timestamp")
+                if cache is not None:
+                    cache.update(instrument, tf, chunk, [(to_ms(d1), to_ms(d2))])
+            else:
+                chunk = cache.load(instrument, tf, to_ms(d1), to_ms(d2))[CANDLE_COLUMNS]
+
+            # Neighbouring windows share their border candle
+            if last is not None:
+                chunk = chunk[chunk.index > last]
+            if len(chunk):
+                last = chunk.index[-1]
+                metrics.count('candles', len(chunk))
+                metrics.maybe_export()
+                yield chunk
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+async def _anext(agen):
+    return await agen.__anext__()
+
+
+async def _aclose(agen):
+    await agen.aclose()
+
+
+def iter_candles(date1, date2, instrument, tf='1', concurrency=MAX_CONCURRENCY, max_candles=MAX_CANDLES,
+                 cache=candle_cache):
+    agen = iter_candles_async(date1, date2, instrument, tf, concurrency, max_candles, cache)
+    try:
+        while True:
+            try:
+                yield async_loop(_anext, agen)
+            except StopAsyncIteration:
+                return
+    finally:
+        async_loop(_aclose, agen)
+
+
+# Sinks append every chunk to a file right away (use them in a "with" block so that they are closed).
+# With append=False an existing file is replaced.
+
+class Sink:
+
+    def write(self, chunk):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# One CSV file, with a header unless it continues an existing file
+
+class CsvSink(Sink):
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self._header = not (append and os.path.exists(path))
+        if not append and os.path.exists(path):
+            os.remove(path)
+
+    def write(self, chunk):
+        chunk.to_csv(self.path, mode='a', header=self._header)
+        self._header = False
+
+
+# One Parquet file in the format of the dataset (see write_candles), one row group per chunk
+
+class ParquetSink(Sink):
+
+    def __init__(self, path, instrument, strike=None, option_type=None):
+        self.path = path
+        self.instrument = instrument
+        self.strike = strike
+        self.option_type = option_type
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._writer = pq.ParquetWriter(path, CANDLE_SCHEMA)
+
+    def write(self, chunk):
+        self._writer.write_table(candles_table(chunk, self.instrument, self.strike, self.option_type))
+
+    def close(self):
+        self._writer.close()
+
+
+# A memory-mapped series (see write_memmap), extended chunk by chunk: DataFrames with a timestamp
+# index with write, or dictionaries of columns (including "ticks") with write_columns
+
+class MemmapSink(Sink):
+
+    def __init__(self, directory, append=False, columns=MEMMAP_COLUMNS):
+        self.directory = directory
+        self.columns = columns
+        os.makedirs(directory, exist_ok=True)
+        self._files = {col: open(os.path.join(directory, col + '.' + dtype[1:]), 'ab' if append else 'wb')
+                       for col, dtype in columns.items()}
+
+    def write(self, chunk):
+        ticks = (chunk.index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+        self.write_columns(dict(chunk, ticks=ticks))
+
+    def write_columns(self, columns):
+        for col, dtype in self.columns.items():
+            self._files[col].write(np.asarray(columns[col], dtype=dtype).tobytes())
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+
+
+# =============================================================================
+# Resampling: coarser resolutions derived from minute candles
+# =============================================================================
+
+# Candles of any resolution in RESOLUTIONS can be built from the stored minute candles instead of
+# downloading them again. Every minute candle belongs to the coarser candle starting at the last
+# multiple of its length since the epoch (so days start at 00:00 UTC, as on Deribit); per coarser
+# candle, open is the first open, close the last close, high the highest high, low the lowest low,
+# and volume and cost are summed. The ticks have to be sorted (as in get_data and MemmapSeries).
+# Candles at the ends of the range are partial if the minute candles don't cover them completely.
+
+def resample_columns(columns, tf):
+    ticks = np.asarray(columns['ticks'], dtype='int64')
+    if len(ticks) == 0:
+        return {col: np.empty(0, dtype=dtype) for col, dtype in MEMMAP_COLUMNS.items()}
+
+    width = RESOLUTIONS[str(tf)] // dt.timedelta(milliseconds=1)
+    buckets = ticks - ticks % width
+
+    # First and last row of every coarser candle
+    first = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[first[1:], len(ticks)] - 1
+
+    return {
+        'ticks': buckets[first],
+        'open': np.asarray(columns['open'], dtype='float64')[first],
+        'high': np.maximum.reduceat(np.asarray(columns['high'], dtype='float64'), first),
+        'low': np.minimum.reduceat(np.asarray(columns['low'], dtype='float64'), first),
+        'close': np.asarray(columns['close'], dtype='float64')[last],
+        'volume': np.add.reduceat(np.asarray(columns['volume'], dtype='float64'), first),
+        'cost': np.add.reduceat(np.asarray(columns['cost'], dtype='float64'), first),
+    }
+
+
+# Resample the result of get_data, or a slice of a MemmapSeries (dictionary of columns), to "tf";
+# the result is in the format of get_data
+
+def resample_candles(candles, tf):
+    if isinstance(candles, pd.DataFrame):
+        candles = dict(candles, ticks=(candles.index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1))
+
+    resampled = resample_columns(candles, tf)
+
+    df = pd.DataFrame({col: resampled[col] for col in CANDLE_COLUMNS})
+    df.index = pd.Index(ms_to_datetime(resampled['ticks']), name='timestamp')
+
+    return df
+
+
+# Derive the "tfs" resolutions of every instrument in the dataset from its "base_tf" candles
+# (optionally only one currency, kind or expiry), written next to the downloaded ones
+
+def resample_dataset(tfs, root=STORE_DIR, currency='*', kind='*', expiry='*', base_tf='1'):
+    paths = glob.glob(os.path.join(partition_dir(root, currency, kind, expiry, base_tf), '*.parquet'))
+
+    for path in paths:
+        df = pq.read_table(path).to_pandas().set_index('timestamp').sort_index()
+        if len(df) == 0:
+            continue
+
+        instrument = df['instrument_name'].iloc[0]
+        strike = None if pd.isna(df['strike'].iloc[0]) else df['strike'].iloc[0]
+        option_type = df['option_type'].iloc[0]
+
+        for tf in tfs:
+            table = candles_table(resample_candles(df, tf), instrument, strike, option_type)
+
+            directory = os.path.join(os.path.dirname(os.path.dirname(path)), f'resolution={tf}')
+            os.makedirs(directory, exist_ok=True)
+            pq.write_table(table, os.path.join(directory, os.path.basename(path)))
+
+    return len(paths)
+
+
+# Compare resampled minute candles ("minute": result of get_data) with the candles of the server on
+# "n_samples" random ranges of "sample_candles" complete candles. Returns one row per range with the
+# number of candles only one side has and the number of values that differ by more than "rtol"
+
+def check_resample(minute, instrument, tf, n_samples=5, sample_candles=50, rtol=1e-6, seed=None):
+    width = RESOLUTIONS[str(tf)]
+    ticks = (minute.index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+    width_ms = width // dt.timedelta(milliseconds=1)
+
+    # Coarser candles completely covered by the minute candles
+    first = -(-ticks[0] // width_ms)
+    last = (ticks[-1] + 60000) // width_ms - 1
+    if last - first + 1 < sample_candles:
+        raise ValueError(f'not enough minute candles for {sample_candles} candles of resolution {tf}')
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    for i in rng.integers(first, last - sample_candles + 2, size=n_samples):
+        start = pd.Timestamp(int(i) * width_ms, unit='ms', tz='UTC')
+        end = start + width * (sample_candles - 1)
+
+        server = get_data(start, end, instrument, tf, cache=None)
+        derived = resample_candles(minute.loc[start:end + width - pd.Timedelta(milliseconds=1)], tf)
+
+        common = server.index.intersection(derived.index)
+        row = {'start': start, 'end': end, 'candles': len(common),
+               'missing': len(server.index.symmetric_difference(derived.index))}
+        for col in CANDLE_COLUMNS:
+            row[col] = int((~np.isclose(derived.loc[common, col], server.loc[common, col], rtol=rtol)).sum())
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
+
+
+# =============================================================================
+# Option chains: dense panels per expiry
+# =============================================================================
+
+# A panel holds one NumPy array per field (open, close, volume, ...) of shape time × strike × 2,
+# with the axes in "times", "strikes" and OPTION_TYPES (call, put); candles that don't exist are NaN.
+# All options of one expiry are one partition of the dataset, so a panel takes one read of that
+# partition and one scatter per field.
+
+OPTION_TYPES = ['call', 'put']
+PANEL_FIELDS = ['open', 'high', 'low', 'close', 'volume', 'cost']
+
+
+class OptionPanel:
+
+    def __init__(self, expiry, times, strikes, fields, tf=None):
+        self.expiry = expiry
+        self.times = times
+        self.strikes = strikes
+        self.fields = fields
+        self.tf = tf
+
+    def __getitem__(self, field):
+        return self.fields[field]
+
+    @property
+    def shape(self):
+        return len(self.times), len(self.strikes), len(OPTION_TYPES)
+
+    # One field of calls or puts as a DataFrame (time × strike)
+    def frame(self, field, option_type='call'):
+        return pd.DataFrame(self.fields[field][:, :, OPTION_TYPES.index(option_type)],
+                            index=self.times, columns=pd.Index(self.strikes, name='strike'))
+
+    # The chain at one time (the last candle at or before it): strike × (call, put)
+    def at(self, time, field='close'):
+        i = max(int(self.times.searchsorted(to_utc(time), side='right')) - 1, 0)
+        return pd.DataFrame(self.fields[field][i], index=pd.Index(self.strikes, name='strike'), columns=OPTION_TYPES)
+
+
+# Timestamps (UTC) as datetime64 values: NumPy sorts these much faster than Timestamp objects
+
+def utc_values(timestamps):
+    return pd.DatetimeIndex(timestamps).tz_convert('UTC').tz_localize(None).to_numpy()
+
+
+# Panel of a DataFrame of candles with the columns timestamp, strike, option_type and the fields
+# (e.g. from read_candles). "strikes" fixes the strike axis (e.g. all strikes listed in the catalog);
+# candles of other strikes are left out
+
+def build_panel(df, expiry=None, fields=PANEL_FIELDS, strikes=None, tf=None):
+    times, t = np.unique(utc_values(df['timestamp']), return_inverse=True)
+
+    if strikes is None:
+        strikes, k = np.unique(df['strike'].to_numpy(), return_inverse=True)
+        rows = slice(None)
+    else:
+        strikes = np.unique(np.asarray(strikes, dtype='float64'))
+        k = np.minimum(np.searchsorted(strikes, df['strike'].to_numpy()), len(strikes) - 1)
+        rows = strikes[k] == df['strike'].to_numpy()
+
+    o = (df['option_type'].to_numpy() == 'put').astype('int64')
+
+    panel = {}
+    for field in fields:
+        values = np.full((len(times), len(strikes), len(OPTION_TYPES)), np.nan)
+        values[t[rows], k[rows], o[rows]] = df[field].to_numpy()[rows]
+        panel[field] = values
+
+    return OptionPanel(expiry, pd.DatetimeIndex(times, name='timestamp').tz_localize('UTC'), strikes, panel, tf)
+
+
+# Panel of one expiry ("YYYY-MM-DD") from the dataset, optionally between start and end.
+# With the instrument catalog, the strike axis holds every strike listed for the expiry
+
+def option_chain_panel(expiry, tf='1D', currency='BTC', fields=PANEL_FIELDS, start=None, end=None, catalog=None,
+                       root=STORE_DIR):
+    expiry = pd.Timestamp(expiry).strftime('%Y-%m-%d')
+
+    # Only the partition of the expiry is opened (not the whole dataset)
+    dataset = ds.dataset(partition_dir(root, currency, 'option', expiry, tf), format='parquet', schema=CANDLE_SCHEMA)
+
+    timestamp = CANDLE_SCHEMA.field('timestamp').type
+    condition = None
+    if start is not None:
+        condition = ds.field('timestamp') >= pa.scalar(to_utc(start), timestamp)
+    if end is not None:
+        c = ds.field('timestamp') <= pa.scalar(to_utc(end), timestamp)
+        condition = c if condition is None else condition & c
+
+    df = dataset.to_table(columns=['timestamp', 'strike', 'option_type'] + list(fields), filter=condition).to_pandas()
+
+    strikes = None
+    if catalog is not None:
+        options = select_instruments(catalog, 'option', expiry, expiry)
+        strikes = options.loc[options['base_currency'] == currency, 'strike'].to_numpy()
+
+    return build_panel(df, expiry, fields, strikes, tf)
+
+
+
+# =============================================================================
+# Options analytics: Black-76 implied volatility and Greeks
+# =============================================================================
+
+# Everything works on NumPy arrays of any (broadcastable) shape, e.g. a whole panel at once.
+# Times to expiry "t" are in years, volatilities annualized, "r" is the continuously compounded rate.
+# Deribit quotes option prices in the underlying currency (BTC, ETH); multiplied by the underlying
+# price they are USD premiums, which is what the formulas below take.
+
+YEAR = dt.timedelta(days=365)
+
+# Deribit options expire at 08:00 UTC of their expiration date
+OPTION_EXPIRY_TIME = dt.timedelta(hours=8)
+
+
+# Standard normal distribution function in double precision (Hart's algorithm as given by West, 2005),
+# so that no further dependency is needed
+
+def norm_cdf(x):
+    x = np.asarray(x, dtype='float64')
+    a = np.abs(x)
+
+    num = (((((0.0352624965998911 * a + 0.700383064443688) * a + 6.37396220353165) * a + 33.912866078383) * a
+            + 112.079291497871) * a + 221.213596169931) * a + 220.206867912376
+    den = ((((((0.0883883476483184 * a + 1.75566716318264) * a + 16.064177579207) * a + 86.7807322029461) * a
+             + 296.564248779674) * a + 637.333633378831) * a + 793.826512519948) * a + 440.413735824752
+    cdf = np.exp(-0.5 * a * a) * num / den
+
+    # Continued fraction in the tails (|x| > 5 sqrt(2)), zero beyond 37
+    tail = np.flatnonzero(a >= 7.07106781186547)
+    if len(tail):
+        b = a.flat[tail]
+        with np.errstate(over='ignore', invalid='ignore'):
+            values = np.exp(-0.5 * b * b) / (b + 1 / (b + 2 / (b + 3 / (b + 4 / (b + 0.65))))) / 2.506628274631
+        cdf.flat[tail] = np.where(b > 37, 0.0, values)
+
+    return np.where(x > 0, 1 - cdf, cdf)
+
+
+def norm_pdf(x):
+    return np.exp(-0.5 * np.square(x)) / np.sqrt(2 * np.pi)
+
+
+def black76_price(f, k, t, sigma, is_call, r=0.0):
+    w = np.where(is_call, 1.0, -1.0)
+    sd = sigma * np.sqrt(t)
+    d1 = (np.log(f / k) + 0.5 * sd * sd) / sd
+    d2 = d1 - sd
+
+    return np.exp(-r * t) * w * (f * norm_cdf(w * d1) - k * norm_cdf(w * d2))
+
+
+# Implied volatility by Newton's (Halley's) method safeguarded with bisection (a step that leaves the bracket
+# of the root is replaced by a bisection step), on all options at once. Prices are solved as the
+# out-of-the-money option of the same strike (via put-call parity), which is better conditioned.
+# Prices outside the no-arbitrage bounds give NaN
+
+def implied_vol(price, f, k, t, is_call, r=0.0, tol=1e-10, max_iter=100, sigma_max=10.0):
+    price, f, k, t, is_call = np.broadcast_arrays(np.asarray(price, dtype='float64'), np.asarray(f, dtype='float64'),
+                                                  np.asarray(k, dtype='float64'), np.asarray(t, dtype='float64'),
+                                                  np.asarray(is_call, dtype=bool))
+    shape = price.shape
+    price, f, k, t, is_call = [a.ravel() for a in (price, f, k, t, is_call)]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Undiscounted price of the out-of-the-money option, relative to the underlying
+        forward_price = price * np.exp(r * t)
+        otm_call = k >= f
+        parity = np.where(is_call, -1.0, 1.0) * (f - k)
+        c = np.where(is_call == otm_call, forward_price, forward_price + parity) / f
+        w = np.where(otm_call, 1.0, -1.0)
+        x = np.log(k / f)
+
+        upper = np.where(otm_call, 1.0, np.exp(x))
+        valid = np.isfinite(c) & np.isfinite(x) & (t > 0) & (c > 0) & (c < upper)
+
+    sigma = np.full(len(price), np.nan)
+    i = np.flatnonzero(valid)
+    c, w, x, sqrt_t = c[i], w[i], x[i], np.sqrt(t[i])
+
+    # Start between the at-the-money approximation (Brenner-Subrahmanyam) and the inflection point
+    s = np.clip(np.maximum(np.sqrt(2 * np.pi) * c, np.sqrt(2 * np.abs(x))), 1e-4, sigma_max * sqrt_t * 0.5)
+    lo = np.zeros(len(i))
+    hi = sigma_max * sqrt_t
+
+    # Solve for the total volatility s = sigma * sqrt(t), with Halley's correction of the Newton step
+    # (the second derivative of the normalized price is vega * d1 * d2 / s)
+    ex = np.exp(x)
+    for _ in range(max_iter):
+        d1 = -x / s + 0.5 * s
+        diff = w * (norm_cdf(w * d1) - ex * norm_cdf(w * (d1 - s))) - c
+        vega = norm_pdf(d1)
+
+        done = np.abs(diff) <= tol * c
+        above = diff > 0
+        hi = np.where(above, s, hi)
+        lo = np.where(above, lo, s)
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = diff / vega
+            step = s - newton / (1 - 0.5 * newton * d1 * (d1 - s) / s)
+        step = np.where((step > lo) & (step < hi), step, 0.5 * (lo + hi))
+        s = np.where(done, s, step)
+
+        # Keep iterating only the options that have not converged
+        if done.all():
+            break
+        if done.any():
+            sigma[i[done]] = s[done] / sqrt_t[done]
+            keep = ~done
+            i, c, w, x, ex, sqrt_t, s, lo, hi = [a[keep] for a in (i, c, w, x, ex, sqrt_t, s, lo, hi)]
+
+    sigma[i] = s / sqrt_t
+    return sigma.reshape(shape)
+
+
+# Black-76 Greeks: delta and gamma with respect to the underlying (futures) price, vega per 1.00
+# of volatility (divide by 100 for one point), theta per year (divide by 365 for one day)
+
+def black76_greeks(f, k, t, sigma, is_call, r=0.0):
+    sd = sigma * np.sqrt(t)
+    d1 = (np.log(f / k) + 0.5 * sd * sd) / sd
+    discount = np.exp(-r * t)
+    pdf = norm_pdf(d1)
+
+    delta = discount * np.where(is_call, norm_cdf(d1), norm_cdf(d1) - 1)
+    gamma = discount * pdf / (f * sd)
+    vega = discount * f * pdf * np.sqrt(t)
+    theta = -discount * f * pdf * sigma / (2 * np.sqrt(t)) + r * black76_price(f, k, t, sigma, is_call, r)
+
+    return {'delta': delta, 'gamma': gamma, 'vega': vega, 'theta': theta}
+
+
+# The underlying of an option expiry: the future expiring at the same time if there is one,
+# otherwise the perpetual contract
+
+def option_underlying(catalog, expiry, currency='BTC'):
+    futures = select_instruments(catalog, 'future', expiry, expiry)
+    futures = futures[(futures['base_currency'] == currency) & (futures['settlement_period'] != 'perpetual')]
+
+    return futures['instrument_name'].iloc[0] if len(futures) else currency + '-PERPETUAL'
+
+
+# Closes of the underlying from the dataset, aligned to the times of a panel
+
+def underlying_prices(panel, instrument, currency='BTC', root=STORE_DIR):
+    expiry = 'perpetual' if instrument.endswith('PERPETUAL') else panel.expiry
+    df = read_candles(root, ['timestamp', 'instrument_name', 'close'], currency, 'future', expiry, panel.tf,
+                      panel.times[0], panel.times[-1])
+    df = df[df['instrument_name'] == instrument].set_index('timestamp').sort_index()
+
+    if df.empty:
+        raise ValueError(f'no {panel.tf} candles of {instrument} in {root} between {panel.times[0]} '
+                         f'and {panel.times[-1]}')
+
+    return df['close'].reindex(panel.times).to_numpy()
+
+
+# Implied volatility and Greeks of a whole panel (see option_chain_panel), added to it as fields
+# 'underlying', 'iv', 'delta', 'gamma', 'vega' and 'theta'. "underlying" holds one price per time
+# of the panel (e.g. from underlying_prices); the options are priced at the end of each candle
+
+def add_greeks(panel, underlying, price_field='close', r=0.0, inverse=True):
+    times = panel.times + (RESOLUTIONS[str(panel.tf)] if panel.tf is not None else pd.Timedelta(0))
+    expiration = pd.Timestamp(panel.expiry, tz='UTC') + OPTION_EXPIRY_TIME
+
+    f = np.asarray(underlying, dtype='float64')[:, None, None]
+    k = panel.strikes[None, :, None]
+    t = ((expiration - times) / YEAR).to_numpy()[:, None, None]
+    is_call = np.array([option_type == 'call' for option_type in OPTION_TYPES])[None, None, :]
+
+    price = panel[price_field] * f if inverse else panel[price_field]
+
+    iv = implied_vol(price, f, k, t, is_call, r)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        greeks = black76_greeks(f, k, t, iv, is_call, r)
+
+    panel.fields['underlying'] = np.broadcast_to(f, panel.shape)
+    panel.fields['iv'] = iv
+    panel.fields.update(greeks)
+
+    return panel
+
+
+
+# =============================================================================
+# Continuous futures: front-month and next-month series stitched from the contracts
+# =============================================================================
+
+# The candles of all contracts are put side by side (time × contract, contracts ordered by expiration),
+# the contract held at every time follows from the roll rule, and the series is gathered from the
+# matrix in one indexing step. Roll rules:
+#   "days":   roll "roll_days" days before the expiration of the held contract
+#   "volume": roll to the next contract after the first candle in which its volume exceeds the volume
+#             of the held one (at the latest at expiration); a roll is never undone
+# Rank 0 is the front month, rank 1 the next month and so on. Back-adjustment removes the jump of
+# every roll from the history before it, using the closes of both contracts in the candle before
+# the roll: "ratio" multiplies earlier prices by new / old, "difference" adds new - old, None keeps
+# the prices as traded. The factor (or offset) applied is in the column "adjustment".
+
+CONTINUOUS_PRICES = ['open', 'high', 'low', 'close']
+
+
+# Candles of all contracts (columns timestamp, instrument_name and the fields) as time × contract
+# matrices, with the contracts in the order of "names"
+
+def contract_matrix(candles, names, fields=CANDLE_COLUMNS):
+    times, t = np.unique(utc_values(candles['timestamp']), return_inverse=True)
+    c = pd.Index(names).get_indexer(candles['instrument_name'])
+    rows = c >= 0
+
+    matrix = {}
+    for field in fields:
+        values = np.full((len(times), len(names)), np.nan)
+        values[t[rows], c[rows]] = candles[field].to_numpy()[rows]
+        matrix[field] = values
+
+    return pd.DatetimeIndex(times, name='timestamp').tz_localize('UTC'), matrix
+
+
+# Position (in the order of expiration) of the contract held at every time
+
+def held_contracts(times, expirations, roll='days', roll_days=0, volume=None):
+    if roll == 'days':
+        return np.searchsorted(expirations - pd.Timedelta(days=roll_days), times, side='right')
+    if roll != 'volume':
+        raise ValueError(f'unknown roll rule: {roll}')
+
+    base = np.searchsorted(expirations, times, side='right')
+    n = volume.shape[1]
+    rows = np.arange(len(times))
+    current = np.where(base < n, volume[rows, np.minimum(base, n - 1)], np.nan)
+    following = np.where(base + 1 < n, volume[rows, np.minimum(base + 1, n - 1)], np.nan)
+
+    # The roll takes effect with the candle after the crossover, and holds until the contract expires
+    crossed = np.r_[False, (following > current)[:-1]]
+    start = np.r_[True, base[1:] != base[:-1]]
+    crossed &= ~start
+    count = np.cumsum(crossed)
+    stretch = np.cumsum(start) - 1
+
+    return base + (count > count[start][stretch]).astype(base.dtype)
+
+
+# Continuous series of rank "rank" from the candles of the contracts ("contracts": e.g. df_fut, with
+# the columns instrument_name and expiration_timestamp), in the format of get_data plus the columns
+# instrument_name (contract held) and adjustment
+
+def continuous_futures(candles, contracts, rank=0, roll='days', roll_days=7, adjust='ratio'):
+    contracts = contracts.sort_values('expiration_timestamp')
+    names = contracts['instrument_name'].to_numpy()
+    expirations = pd.DatetimeIndex(contracts['expiration_timestamp'])
+
+    times, matrix = contract_matrix(candles, names)
+    held = held_contracts(times, expirations, roll, roll_days, matrix['volume']) + rank
+
+    # Times at which the held contract exists and has a candle
+    rows = np.flatnonzero(held < len(names))
+    rows = rows[~np.isnan(matrix['close'][rows, held[rows]])]
+    held = held[rows]
+    series = {field: values[rows, held] for field, values in matrix.items()}
+
+    # Closes of the old and the new contract in the candle before every roll (the new contract's
+    # first close if it has no candle there)
+    rolls = np.flatnonzero(held[1:] != held[:-1]) + 1
+    old = matrix['close'][rows[rolls - 1], held[rolls - 1]]
+    new = matrix['close'][rows[rolls - 1], held[rolls]]
+    new = np.where(np.isnan(new), series['close'][rolls], new)
+
+    if adjust == 'ratio':
+        jumps = np.ones(len(rows))
+        jumps[rolls] = np.where(np.isfinite(new / old), new / old, 1.0)
+        adjustment = np.r_[np.cumprod(jumps[::-1])[::-1][1:], 1.0]
+        for field in CONTINUOUS_PRICES:
+            series[field] = series[field] * adjustment
+    elif adjust == 'difference':
+        jumps = np.zeros(len(rows))
+        jumps[rolls] = np.where(np.isfinite(new - old), new - old, 0.0)
+        adjustment = np.r_[np.cumsum(jumps[::-1])[::-1][1:], 0.0]
+        for field in CONTINUOUS_PRICES:
+            series[field] = series[field] + adjustment
+    elif adjust is None:
+        adjustment = np.ones(len(rows))
+    else:
+        raise ValueError(f'unknown back-adjustment: {adjust}')
+
+    df = pd.DataFrame({field: series[field] for field in CANDLE_COLUMNS}, index=times[rows])
+    df['instrument_name'] = names[held]
+    df['adjustment'] = adjustment
+
+    return df
+
+
+# Candles of all futures contracts (without the perpetual contract) of one resolution from the dataset
+
+def read_contract_candles(tf, currency='BTC', root=STORE_DIR):
+    candles = read_candles(root, ['timestamp', 'instrument_name'] + CANDLE_COLUMNS, currency, 'future', tf=tf)
+
+    return candles[~candles['instrument_name'].str.endswith('PERPETUAL')]
+
+
+
+# =============================================================================
+# Bulk downloads: resumable job scheduler
+# =============================================================================
+
+# A bulk download is a list of work units (instrument, resolution, time range) kept in a SQLite journal
+# together with everything needed to store the result. Every unit is marked as done or failed as soon
+# as it finishes, so after a crash or a network drop the same call continues where it stopped:
+# finished units are skipped, failed (and interrupted) ones are tried again.
+
+# Number of units downloaded at the same time, and attempts per unit before giving up
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_ATTEMPTS = 3
+
+JOURNAL_COLUMNS = ['instrument_name', 'resolution', 'start_ms', 'end_ms',
+                   'currency', 'kind', 'expiry', 'strike', 'option_type']
+
+
+class DownloadJournal:
+
+    def __init__(self, path):
+        self.path = path
+        # The journal is written from the thread of the event loop running the downloads
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS units (
+                instrument_name TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                start_ms INTEGER NOT NULL,
+                end_ms INTEGER NOT NULL,
+                currency TEXT,
+                kind TEXT,
+                expiry TEXT,
+                strike REAL,
+                option_type TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                updated REAL,
+                PRIMARY KEY (instrument_name, resolution, start_ms, end_ms)
+            )""")
+        self.db.commit()
+
+    # Add units (a DataFrame with JOURNAL_COLUMNS); units that are already in the journal are kept as they are
+    def add(self, units):
+        rows = units[JOURNAL_COLUMNS].astype(object).where(units[JOURNAL_COLUMNS].notna(), None)
+        self.db.executemany(
+            f"INSERT OR IGNORE INTO units ({', '.join(JOURNAL_COLUMNS)}) VALUES ({', '.join('?' * len(JOURNAL_COLUMNS))})",
+            rows.itertuples(index=False, name=None))
+        self.db.commit()
+
+    # Units still to download: not done yet and not out of attempts
+    def todo(self, max_attempts=DOWNLOAD_ATTEMPTS):
+        return pd.read_sql_query(
+            "SELECT * FROM units WHERE status != 'done' AND attempts < ? ORDER BY instrument_name, resolution, start_ms",
+            self.db, params=(max_attempts,))
+
+    def mark(self, unit, status, error=None):
+        self.db.execute(
+            "UPDATE units SET status = ?, error = ?, updated = ?, attempts = attempts + ? "
+            "WHERE instrument_name = ? AND resolution = ? AND start_ms = ? AND end_ms = ?",
+            (status, error, time.time(), int(status == 'failed'),
+             unit['instrument_name'], unit['resolution'], int(unit['start_ms']), int(unit['end_ms'])))
+        self.db.commit()
+
+    def failed(self):
+        return pd.read_sql_query("SELECT * FROM units WHERE status = 'failed'", self.db)
+
+    def summary(self):
+        return pd.read_sql_query("SELECT status, COUNT(*) AS units FROM units GROUP BY status", self.db)
+
+    def close(self):
+        self.db.close()
+
+
+# Work units for every instrument of a catalog selection (see select_instruments) and resolution,
+# each covering the whole life of the instrument (creation to expiration)
+
+def download_units(df, tfs):
+    units = pd.DataFrame({
+        'instrument_name': df['instrument_name'],
+        'start_ms': (df['creation_timestamp'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1),
+        'end_ms': (df['expiration_timestamp'] - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1),
+        'currency': df['base_currency'],
+        'kind': df['kind'],
+        'expiry': df['expiration_timestamp'].dt.strftime('%Y-%m-%d'),
+        'strike': df['strike'] if 'strike' in df else np.nan,
+        'option_type': df['option_type'] if 'option_type' in df else None,
+    })
+
+    return pd.concat([units.assign(resolution=str(tf)) for tf in tfs], ignore_index=True)
+
+
+async def download_unit(unit, root=STORE_DIR, cache=candle_cache):
+    start = pd.Timestamp(unit['start_ms'], unit='ms', tz='UTC')
+    end = pd.Timestamp(unit['end_ms'], unit='ms', tz='UTC')
+
+    df = await get_data_async(start, end, unit['instrument_name'], unit['resolution'], cache=cache)
+
+    write_candles(df, unit['instrument_name'], unit['resolution'], unit['currency'], unit['kind'], unit['expiry'],
+                  strike=None if pd.isna(unit['strike']) else unit['strike'],
+                  option_type=unit['option_type'], root=root)
+
+
+# Download all open units of the journal with a bounded pool of workers. Failed units are retried
+# in further rounds (up to max_attempts per unit), finished ones are never downloaded again.
+# "cache" is the candle cache of get_data (None: download everything)
+
+async def run_downloads_async(journal, root=STORE_DIR, workers=DOWNLOAD_WORKERS, max_attempts=DOWNLOAD_ATTEMPTS,
+                              cache=candle_cache):
+    while True:
+        todo = journal.todo(max_attempts)
+        if todo.empty:
+            break
+
+        queue = asyncio.Queue()
+        for unit in todo.to_dict('records'):
+            queue.put_nowait(unit)
+
+        async def worker():
+            while not queue.empty():
+                unit = queue.get_nowait()
+                metrics.gauge('download_queue', queue.qsize())
+                journal.mark(unit, 'running')
+                try:
+                    await download_unit(unit, root, cache)
+                except Exception as e:
+                    logger.warning('Error when collecting data: %s (%s): %r', unit['instrument_name'], unit['resolution'], e)
+                    journal.mark(unit, 'failed', repr(e))
+                    metrics.count('units_failed')
+                else:
+                    journal.mark(unit, 'done')
+                    metrics.count('units_done')
+
+        await asyncio.gather(*[worker() for _ in range(workers)])
+
+    metrics.export()
+    return journal.summary()
+
+
+def run_downloads(journal, root=STORE_DIR, workers=DOWNLOAD_WORKERS, max_attempts=DOWNLOAD_ATTEMPTS,
+                  cache=candle_cache):
+    return async_loop(run_downloads_async, journal, root, workers, max_attempts, cache)
+
+
+
+
+# =============================================================================
+# Legacy CSV archive: parallel import into the store
+# =============================================================================
+
+# The earlier versions of this script saved every get_data result as its own CSV file:
+#   E:/Options/Daily/<day>/option-daily_<instrument>.csv, E:/Futures/Daily/<day>/future-daily_<instrument>.csv,
+#   E:/Futures/{Hourly,Minutely}/future-{hourly,minutely}_<instrument>.csv, E:/Perpetual/perpetual_<period>.csv
+# import_legacy walks such a tree and moves the candles into the Parquet dataset, one instrument and
+# resolution per task on a pool of threads. The imported ranges are also recorded in the candle
+# cache, so that get_data and run_downloads only request what the archive doesn't have.
+
+LEGACY_FILE_PATTERN = r'^(?P<kind>option|future|perpetual)[-_](?P<period>daily|hourly|minutely)(?:_(?P<instrument>.+))?\.csv$'
+LEGACY_RESOLUTIONS = {'daily': '1D', 'hourly': '60', 'minutely': '1'}
+
+# Timestamps as the earlier versions wrote them: naive UTC (from utcfromtimestamp) or with an offset
+LEGACY_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M:%S%z', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%S%z']
+
+# Files already imported (path, size, modification time) are listed here, in the root of the dataset
+# (names starting with "_" are ignored by read_candles)
+LEGACY_MANIFEST = '_legacy_imports.csv'
+
+IMPORT_WORKERS = os.cpu_count()
+
+
+# All candle files below "archive" with the instrument and resolution given by their names
+# (the perpetual files were only written for one instrument, which has to be named)
+
+def legacy_files(archive, perpetual='BTC-PERPETUAL'):
+    rows = []
+    for path in glob.glob(os.path.join(archive, '**', '*.csv'), recursive=True):
+        match = re.match(LEGACY_FILE_PATTERN, os.path.basename(path))
+        if match is None:
+            continue
+
+        stat = os.stat(path)
+        rows.append((os.path.abspath(path), match['instrument'] or perpetual, LEGACY_RESOLUTIONS[match['period']],
+                     stat.st_size, stat.st_mtime_ns))
+
+    return pd.DataFrame(rows, columns=['path', 'instrument_name', 'resolution', 'size', 'mtime_ns'])
+
+
+# Candles of one legacy file with a UTC timestamp index and float columns. Rows with an unreadable
+# timestamp or price, a timestamp off the resolution's grid, or prices outside of their low/high range
+# are dropped; returns the candles and the number of dropped rows.
+# The file is parsed by Arrow (in C++, outside of the GIL, so import_legacy's threads run in parallel):
+# typed price columns, timestamps in the LEGACY_TIME_FORMATS. Only timestamps of other formats go
+# through pandas, and a file with a price that isn't a number is read by pandas entirely
+
+def read_legacy_csv(path, tf):
+    try:
+        timestamp, candles = _read_legacy_arrow(path)
+    except pa.ArrowInvalid:
+        timestamp, candles = _read_legacy_pandas(path)
+
+    candles.index = pd.DatetimeIndex(timestamp, name='timestamp')
+
+    ms = (timestamp - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+    width = RESOLUTIONS[tf] // dt.timedelta(milliseconds=1)
+
+    valid = (timestamp.notna() & (ms % width == 0)
+             & candles.notna().all(axis=1).to_numpy()
+             & (candles['low'] <= candles[['open', 'close']].min(axis=1)).to_numpy()
+             & (candles['high'] >= candles[['open', 'close']].max(axis=1)).to_numpy()
+             & (candles['volume'] >= 0).to_numpy())
+
+    return candles[valid.to_numpy()], int((~valid).sum())
+
+
+def _read_legacy_arrow(path):
+    types = dict({c: pa.float64() for c in CANDLE_COLUMNS}, ticks=pa.float64(), timestamp=pa.string())
+    table = pcsv.read_csv(path, convert_options=pcsv.ConvertOptions(column_types=types))
+
+    # Naive timestamps (written from utcfromtimestamp) are UTC; files of newer versions carry the offset
+    if 'timestamp' in table.column_names:
+        text = table['timestamp']
+        ms = None
+        for f in LEGACY_TIME_FORMATS:
+            parsed = pc.strptime(text, format=f, unit='ms', error_is_null=True).cast(pa.int64())
+            ms = parsed if ms is None else pc.coalesce(ms, parsed)
+            if ms.null_count == text.null_count:
+                break
+        timestamp = pd.Series(pd.to_datetime(ms.to_numpy(zero_copy_only=False), unit='ms', utc=True))
+
+        other = np.flatnonzero(pc.and_(pc.is_null(ms), pc.is_valid(text)).to_numpy(zero_copy_only=False))
+        if len(other):
+            timestamp.iloc[other] = pd.to_datetime(text.take(other).to_pandas(), utc=True, errors='coerce').array
+    else:
+        ms = pc.multiply(table['ticks'], 1000).to_numpy(zero_copy_only=False)
+        timestamp = pd.Series(pd.to_datetime(ms, unit='ms', utc=True))
+
+    return timestamp, table.select(CANDLE_COLUMNS).to_pandas()
+
+
+def _read_legacy_pandas(path):
+    df = pd.read_csv(path)
+
+    if 'timestamp' in df:
+        timestamp = pd.to_datetime(df['timestamp'], utc=True, errors='coerce')
+    else:
+        timestamp = pd.to_datetime(pd.to_numeric(df['ticks'], errors='coerce') * 1000, unit='ms', utc=True)
+
+    candles = pd.DataFrame({c: pd.to_numeric(df[c], errors='coerce').astype('float64') for c in CANDLE_COLUMNS})
+    return timestamp, candles
+
+
+# Runs of consecutive candles as covered time ranges (milliseconds) for the candle cache
+
+def candle_runs(index, tf):
+    width = RESOLUTIONS[tf] // dt.timedelta(milliseconds=1)
+    ms = (index - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(milliseconds=1)
+    ms = np.asarray(ms, dtype='int64')
+    if len(ms) == 0:
+        return []
+
+    breaks = np.flatnonzero(np.diff(ms) > width) + 1
+    starts = ms[np.r_[0, breaks]]
+    ends = ms[np.r_[breaks - 1, len(ms) - 1]] + width
+
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+# One task of the pool: all legacy files of one instrument and resolution, merged with the candles of
+# the dataset file they go to (those win over the archive) and written back. Returns a small summary
+# only, the candles stay in the worker
+
+def import_legacy_instrument(paths, instrument, tf, root=STORE_DIR, cache=candle_cache):
+    parts, n_rows, n_invalid = [], 0, 0
+    for path in paths:
+        df, invalid = read_legacy_csv(path, tf)
+        parts.append(df)
+        n_rows += len(df) + invalid
+        n_invalid += invalid
+
+    info = parse_instruments([instrument]).iloc[0]
+    if pd.isna(info['kind']):
+        raise ValueError(f'not an instrument name: {instrument}')
+
+    expiry = 'perpetual' if pd.isna(info['expiration_timestamp']) else info['expiration_timestamp'].strftime('%Y-%m-%d')
+    target = os.path.join(partition_dir(root, info['currency'], info['kind'], expiry, tf), instrument + '.parquet')
+
+    if os.path.exists(target):
+        stored = pq.read_table(target).to_pandas().set_index('timestamp')[CANDLE_COLUMNS]
+        parts.insert(0, stored)
+        n_stored = len(stored)
+    else:
+        n_stored = 0
+
+    df = pd.concat(parts)
+    n_unique = len(df)
+    df = df[~df.index.duplicated(keep='first')].sort_index()
+
+    write_candles(df, instrument, tf, info['currency'], info['kind'], expiry,
+                  strike=None if pd.isna(info['strike']) else info['strike'],
+                  option_type=None if pd.isna(info['option_type']) else info['option_type'], root=root)
+
+    if cache is not None:
+        cache.update(instrument, tf, df, candle_runs(df.index, tf))
+
+    return {'instrument_name': instrument, 'resolution': tf, 'files': len(paths), 'rows': n_rows,
+            'invalid': n_invalid, 'duplicates': n_unique - len(df), 'imported': len(df) - n_stored}
+
+
+# Import every legacy file below "archive" that isn't in the manifest yet (or changed since), largest
+# tasks first. The tasks run on threads: parsing (Arrow's CSV reader and strptime) and the Parquet writer
+# release the GIL, which leaves about a third of a task to pandas under it, and worker processes would either be forked while the session's event loop thread
+# runs, or be spawned and run deribit.py again, cells included, when it is the main script.
+# Returns one row per instrument and resolution; failed tasks have their error in "error"
+
+def import_legacy(archive, root=STORE_DIR, perpetual='BTC-PERPETUAL', workers=IMPORT_WORKERS, cache=candle_cache):
+    files = legacy_files(archive, perpetual)
+
+    manifest_path = os.path.join(root, LEGACY_MANIFEST)
+    if os.path.exists(manifest_path):
+        manifest = pd.read_csv(manifest_path)
+        done = files.merge(manifest[['path', 'size', 'mtime_ns']], how='left', indicator=True)['_merge'] == 'both'
+        files = files[~done.to_numpy()]
+    else:
+        manifest = files.iloc[:0]
+
+    tasks = files.groupby(['instrument_name', 'resolution'])
+    tasks = sorted(tasks, key=lambda task: -task[1]['size'].sum())
+
+    results, imported = [], []
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {executor.submit(import_legacy_instrument, list(group['path']), instrument, tf, root, cache): group
+                   for (instrument, tf), group in tasks}
+
+        for future in concurrent.futures.as_completed(futures):
+            group = futures[future]
+            instrument, tf = group['instrument_name'].iloc[0], group['resolution'].iloc[0]
+            try:
+                results.append(future.result())
+            except Exception as e:
+                logger.warning('Error when importing %s (%s): %r', instrument, tf, e)
+                results.append({'instrument_name': instrument, 'resolution': tf, 'files': len(group), 'error': repr(e)})
+                metrics.count('imports_failed')
+            else:
+                imported.append(group)
+                metrics.count('imports_done')
+                metrics.count('candles_imported', results[-1]['imported'])
+
+    if imported:
+        os.makedirs(root, exist_ok=True)
+        manifest = pd.concat([manifest] + imported, ignore_index=True).drop_duplicates('path', keep='last')
+        manifest.to_csv(manifest_path + '.tmp', index=False)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    metrics.export()
+    return pd.DataFrame(results, columns=['instrument_name', 'resolution', 'files', 'rows', 'invalid',
+                                          'duplicates', 'imported', 'error'])
+
+
+# =============================================================================
+# Raw trades: paginated downloads
+# =============================================================================
+
+# public/get_last_trades_by_instrument_and_time returns up to MAX_TRADES trades per request, oldest
+# first, with "has_more" if the range holds more. A range is split into slices of "slice_window"
+# that are downloaded concurrently through the same session as get_data; every slice follows its
+# pages (the next page starts at the time of the last trade, so the borders overlap and are
+# deduplicated by trade id). Trades are kept as typed columns, not as dictionaries, and written as
+# a memory-mapped series (see MemmapSeries) slice by slice in time order, so memory stays the same
+# however many trades a contract has.
+
+MAX_TRADES = 1000
+TRADE_SLICE = dt.timedelta(days=1)
+
+TRADE_COLUMNS = {
+    'ticks': '<i8',             # milliseconds since UNIX epoch
+    'trade_id': '<i8',          # numeric part of the trade id ("ETH-2696083" -> 2696083)
+    'trade_seq': '<i8',         # sequence number of the trade within the instrument
+    'price': '<f8',
+    'amount': '<f8',
+    'direction': '<i1',         # 1: buy, -1: sell
+    'tick_direction': '<i1',
+    'index_price': '<f8',
+    'mark_price': '<f8',
+    'iv': '<f8',                # options only (NaN otherwise)
+}
+
+
+def trades_msg(start, end, instrument, count=MAX_TRADES):
+    return \
+        {
+            "jsonrpc": "2.0",
+            "method": "public/get_last_trades_by_instrument_and_time",
+            "params": {
+                "instrument_name": instrument,
+                "start_timestamp": int(start),
+                "end_timestamp": int(end),
+                "count": count,
+                "include_old": True,
+                "sorting": "asc"
+            }
+        }
+
+
+# Trades after a sequence number (used when more than a page of trades share one millisecond)
+
+def trades_by_seq_msg(start_seq, instrument, count=MAX_TRADES):
+    return \
+        {
+            "jsonrpc": "2.0",
+            "method": "public/get_last_trades_by_instrument",
+            "params": {
+                "instrument_name": instrument,
+                "start_seq": int(start_seq),
+                "count": count,
+                "include_old": True,
+                "sorting": "asc"
+            }
+        }
+
+
+def trades_to_columns(trades):
+    return {
+        'ticks': np.array([t['timestamp'] for t in trades], dtype='int64'),
+        'trade_id': np.array([int(str(t['trade_id']).rsplit('-', 1)[-1]) for t in trades], dtype='int64'),
+        'trade_seq': np.array([t['trade_seq'] for t in trades], dtype='int64'),
+        'price': np.array([t['price'] for t in trades], dtype='float64'),
+        'amount': np.array([t['amount'] for t in trades], dtype='float64'),
+        'direction': np.array([1 if t['direction'] == 'buy' else -1 for t in trades], dtype='int8'),
+        'tick_direction': np.array([t.get('tick_direction', -1) for t in trades], dtype='int8'),
+        'index_price': np.array([t.get('index_price', np.nan) for t in trades], dtype='float64'),
+        'mark_price': np.array([t.get('mark_price', np.nan) for t in trades], dtype='float64'),
+        'iv': np.array([t.get('iv', np.nan) for t in trades], dtype='float64'),
+    }
+
+
+# Concatenate pages of columns, sorted by time and sequence, without duplicate trade ids
+
+def merge_trade_columns(pages):
+    if not pages:
+        return {col: np.empty(0, dtype=dtype) for col, dtype in TRADE_COLUMNS.items()}
+
+    columns = {col: np.concatenate([page[col] for page in pages]) for col in TRADE_COLUMNS}
+    _, unique = np.unique(columns['trade_id'], return_index=True)
+    order = unique[np.lexsort((columns['trade_seq'][unique], columns['ticks'][unique]))]
+
+    return {col: values[order] for col, values in columns.items()}
+
+
+# All trades between start and end (milliseconds, both inclusive), page by page
+
+async def retrieve_trade_slice(start, end, instrument, count=MAX_TRADES):
+    pages = []
+    t = start
+
+    while True:
+        res = await call_api(trades_msg(t, end, instrument, count), parse=True)
+        trades = res['result']['trades']
+        if trades:
+            pages.append(trades_to_columns(trades))
+        if not trades or not res['result']['has_more']:
+            break
+
+        if trades[-1]['timestamp'] > t:
+            t = trades[-1]['timestamp']
+            continue
+
+        # A whole page within one millisecond: continue by sequence number until it is over
+        seq = trades[-1]['trade_seq']
+        while True:
+            res = await call_api(trades_by_seq_msg(seq + 1, instrument, count), parse=True)
+            same = [trade for trade in res['result']['trades'] if trade['timestamp'] == t]
+            if same:
+                pages.append(trades_to_columns(same))
+                seq = same[-1]['trade_seq']
+            if len(same) < len(res['result']['trades']) or not res['result']['has_more']:
+                break
+        t += 1
+
+    return merge_trade_columns(pages)
+
+
+# Yields the trades of a range slice by slice (dictionaries of columns), in time order. At most
+# "concurrency" slices are downloaded ahead of the one being yielded
+
+async def iter_trades_async(date1, date2, instrument, concurrency=MAX_CONCURRENCY, slice_window=TRADE_SLICE,
+                            after_seq=-1):
+    slices = collections.deque(plan_chunks(to_utc(date1), to_utc(date2), None, window=slice_window))
+    in_flight = collections.deque()
+
+    try:
+        while slices or in_flight:
+            while slices and len(in_flight) < concurrency:
+                d1, d2 = slices.popleft()
+                in_flight.append(asyncio.ensure_future(
+                    retrieve_trade_slice(to_ms(d1), to_ms(d2), instrument)))
+
+            columns = await in_flight.popleft()
+
+            # Neighbouring slices share their border millisecond
+            keep = columns['trade_seq'] > after_seq
+            if keep.any():
+                columns = {col: values[keep] for col, values in columns.items()}
+                after_seq = columns['trade_seq'][-1]
+                metrics.count('trades', len(columns['ticks']))
+                metrics.maybe_export()
+                yield columns
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+
+# Download the trades of a range into a memory-mapped series (read it with
+# MemmapSeries(directory, TRADE_COLUMNS)). With append=True an existing series is continued
+# after its last trade: only the range from the millisecond of that trade on is requested.
+# Returns the number of trades written
+
+async def download_trades_async(date1, date2, instrument, directory, concurrency=MAX_CONCURRENCY,
+                                slice_window=TRADE_SLICE, append=False):
+    after_seq = -1
+    path = os.path.join(directory, 'trade_seq.' + TRADE_COLUMNS['trade_seq'][1:])
+    if append and os.path.exists(path) and os.path.getsize(path) > 0:
+        stored = MemmapSeries(directory, TRADE_COLUMNS)
+        after_seq = int(stored.columns['trade_seq'][-1])
+        date1 = max(to_utc(date1), pd.Timestamp(int(stored.ticks[-1]), unit='ms', tz='UTC'))
+        del stored
+
+    n_trades = 0
+    with MemmapSink(directory, append, TRADE_COLUMNS) as sink:
+        async for columns in iter_trades_async(date1, date2, instrument, concurrency, slice_window, after_seq):
+            sink.write_columns(columns)
+            n_trades += len(columns['ticks'])
+
+    return n_trades
+
+
+def download_trades(date1, date2, instrument, directory, concurrency=MAX_CONCURRENCY, slice_window=TRADE_SLICE,
+                    append=False):
+    return async_loop(download_trades_async, date1, date2, instrument, directory, concurrency, slice_window, append)
+
+
+# Trades of a (shorter) range as a DataFrame with a timestamp index
+
+async def get_trades_async(date1, date2, instrument, concurrency=MAX_CONCURRENCY, slice_window=TRADE_SLICE):
+    pages = [columns async for columns in iter_trades_async(date1, date2, instrument, concurrency, slice_window)]
+    columns = merge_trade_columns(pages)
+
+    df = pd.DataFrame({col: values for col, values in columns.items() if col != 'ticks'})
+    df.index = pd.Index(ms_to_datetime(columns['ticks']), name='timestamp')
+
+    return df
+
+
+def get_trades(date1, date2, instrument, concurrency=MAX_CONCURRENCY, slice_window=TRADE_SLICE):
+    return async_loop(get_trades_async, date1, date2, instrument, concurrency, slice_window)
+
+
+
+# =============================================================================
+# Live collector: subscriptions appended to storage
+# =============================================================================
+
+# A long-running collector that keeps series current, instead of downloading overlapping history on a
+# schedule. It subscribes to chart.trades.<instrument>.<resolution> (and optionally trades.<instrument>.100ms)
+# for all instruments on its own websocket connection, and appends every completed candle to a
+# memory-mapped series per instrument and resolution (see MemmapSeries), trades to one per instrument
+# (in the layout of download_trades).
+#
+# A candle is complete once its period has ended (plus COMPLETION_DELAY seconds). Every "flush_interval"
+# seconds the complete candles are appended, so storage is never more than that behind. Candles that no
+# notification delivered (the connection was down, or there were no trades) are requested with get_data,
+# so a series has no gaps and continues the candles already stored, after a restart as well.
+# The server sends heartbeats; if nothing arrives for two heartbeat intervals the connection counts as
+# dead and is opened again (with backoff, like failed requests). Trades sent while the connection was
+# down are not requested again (download_trades can fill them in).
+
+LIVE_DIR = r'E:\Live'
+
+HEARTBEAT_INTERVAL = 30     # seconds (Deribit accepts 10 or more)
+FLUSH_INTERVAL = 5
+COMPLETION_DELAY = 2
+
+
+class LiveCollector:
+
+    def __init__(self, instruments, tfs=('1',), trades=False, directory=LIVE_DIR, url=None,
+                 heartbeat=HEARTBEAT_INTERVAL, flush_interval=FLUSH_INTERVAL):
+        self.url = url
+        self.directory = directory
+        self.heartbeat = heartbeat
+        self.flush_interval = flush_interval
+
+        self.series = {}
+        for instrument in instruments:
+            for tf in map(str, tfs):
+                path = os.path.join(directory, f'{instrument}_{tf}')
+                self.series[f'chart.trades.{instrument}.{tf}'] = {
+                    'instrument': instrument,
+                    'tf': tf,
+                    'width': RESOLUTIONS[tf] // dt.timedelta(milliseconds=1),
+                    'path': path,
+                    'candles': {},                  # tick -> latest notification of the candle
+                    'last': self.stored_last(path),  # tick of the last stored candle
+                }
+
+        self.trade_channels = {f'trades.{instrument}.100ms': instrument for instrument in instruments} if trades else {}
+        self._trades = collections.defaultdict(list)
+
+        self._ids = itertools.count(1)
+        self._subscribe_id = None
+        self._attempt = 0
+        self.websocket = None
+        self.stopped = False
+        self.stats = collections.Counter()
+
+    @staticmethod
+    def stored_last(path):
+        ticks = os.path.join(path, 'ticks.' + MEMMAP_COLUMNS['ticks'][1:])
+        if not os.path.exists(ticks) or os.path.getsize(ticks) == 0:
+            return None
+
+        return int(MemmapSeries(path).ticks[-1])
+
+    @property
+    def channels(self):
+        return list(self.series) + list(self.trade_channels)
+
+    async def _send(self, websocket, method, params=None):
+        msg_id = next(self._ids)
+        await websocket.send(json.dumps({'jsonrpc': '2.0', 'id': msg_id, 'method': method, 'params': params or {}}))
+        return msg_id
+
+    def _on_notification(self, channel, data):
+        series = self.series.get(channel)
+        if series is not None:
+            if series['last'] is None or data['tick'] > series['last']:
+                series['candles'][data['tick']] = data
+        elif channel in self.trade_channels:
+            self._trades[self.trade_channels[channel]].extend(data)
+
+    async def _listen(self, websocket):
+        await self._send(websocket, 'public/set_heartbeat', {'interval': self.heartbeat})
+        self._subscribe_id = await self._send(websocket, 'public/subscribe', {'channels': self.channels})
+
+        while not self.stopped:
+            try:
+                message = await asyncio.wait_for(websocket.recv(), 2 * self.heartbeat)
+            except asyncio.TimeoutError:
+                raise ConnectionError(f'no message for {2 * self.heartbeat} seconds')
+
+            msg = json_loads(message)
+            method = msg.get('method')
+
+            if method == 'subscription':
+                self._on_notification(msg['params']['channel'], msg['params']['data'])
+            elif method == 'heartbeat':
+                if msg['params'].get('type') == 'test_request':
+                    await self._send(websocket, 'public/test')
+            elif 'error' in msg:
+                check_response(msg)
+            elif msg.get('id') == self._subscribe_id:
+                self._attempt = 0
+
+    # Append the complete candles of one series, with the missing ones requested from the API
+
+    async def _flush_series(self, series, now):
+        width = series['width']
+        complete = now - now % width - width        # tick of the last complete candle
+
+        last = series['last']
+        if last is None:
+            # Nothing stored yet: the series starts with the first candle received
+            ticks = [tick for tick in series['candles'] if tick <= complete]
+            if not ticks:
+                return
+            last = min(ticks) - width
+        if complete <= last:
+            return
+
+        live = [candle for tick, candle in series['candles'].items() if last < tick <= complete]
+        df = pd.DataFrame({col: [candle[col] for candle in live] for col in CANDLE_COLUMNS})
+        df.index = pd.Index(ms_to_datetime([candle['tick'] for candle in live]), name='timestamp')
+
+        if len(df) < (complete - last) // width:
+            fetched = await get_data_async(pd.Timestamp(last + width, unit='ms', tz='UTC'),
+                                           pd.Timestamp(complete, unit='ms', tz='UTC'),
+                                           series['instrument'], series['tf'], cache=None)
+            df = pd.concat([fetched, df[~df.index.isin(fetched.index)]])
+            self.stats['candles_fetched'] += len(fetched)
+
+        df = df.sort_index()
+        df = df[df.index > pd.Timestamp(last, unit='ms', tz='UTC')]
+        if len(df) == 0:
+            return
+
+        with MemmapSink(series['path'], append=True) as sink:
+            sink.write(df)
+
+        # Only as far as the candles written: missing ones are asked for again with the next flush
+        series['last'] = to_ms(df.index[-1])
+        series['candles'] = {tick: candle for tick, candle in series['candles'].items() if tick > series['last']}
+        self.stats['candles'] += len(df)
+        metrics.count('live_candles', len(df))
+
+    async def flush(self):
+        now = int(time.time() * 1000) - COMPLETION_DELAY * 1000
+
+        for series in self.series.values():
+            try:
+                await self._flush_series(series, now)
+            except Exception as e:
+                # The candles stay buffered and are appended with the next flush
+                logger.warning('Appending %s failed: %r', series['path'], e)
+
+        trades, self._trades = self._trades, collections.defaultdict(list)
+        for instrument, rows in trades.items():
+            with MemmapSink(os.path.join(self.directory, f'{instrument}_trades'), True, TRADE_COLUMNS) as sink:
+                sink.write_columns(merge_trade_columns([trades_to_columns(rows)]))
+            self.stats['trades'] += len(rows)
+
+        metrics.gauge('live_buffered', sum(len(series['candles']) for series in self.series.values()))
+        metrics.maybe_export()
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    # Runs until stop() is called (or for "duration" seconds), then appends what is complete
+
+    async def run_async(self, duration=None):
+        os.makedirs(self.directory, exist_ok=True)
+        self.stopped = False
+        if duration is not None:
+            asyncio.get_running_loop().call_later(duration, self.stop)
+
+        flusher = asyncio.ensure_future(self._flush_periodically())
+        try:
+            while not self.stopped:
+                try:
+                    async with websockets.connect(self.url or session.url, max_size=None) as websocket:
+                        self.websocket = websocket
+                        await self._listen(websocket)
+                except (ConnectionError, OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+                    failure = e
+                except DeribitError as e:
+                    if e.code not in TRANSIENT_ERRORS:
+                        raise
+                    failure = e
+                finally:
+                    self.websocket = None
+
+                if not self.stopped:
+                    delay = backoff_delay(min(self._attempt, MAX_RETRIES))
+                    logger.warning('live connection lost (%r), reconnecting in %.1f seconds', failure, delay)
+                    self.stats['reconnects'] += 1
+                    metrics.count('reconnects')
+                    self._attempt += 1
+                    await asyncio.sleep(delay)
+        finally:
+            flusher.cancel()
+            await self.flush()
+
+        return dict(self.stats)
+
+    def stop(self):
+        self.stopped = True
+        if self.websocket is not None:
+            asyncio.ensure_future(self.websocket.close())
+
+    # Blocks until stopped; Ctrl+C stops the collector after a last flush
+    def run(self, duration=None):
+        loop = background_loop()
+        future = asyncio.run_coroutine_threadsafe(self.run_async(duration), loop)
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            loop.call_soon_threadsafe(self.stop)
+            return future.result()
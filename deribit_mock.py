@@ -0,0 +1,445 @@
+# Offline stand-in for the Deribit API, and the fetch benchmark that runs against it
+# (see the benchmark cell in deribit.py and test_deribit.py)
+
+import asyncio
+import websockets # Can be installed via anaconda environments
+import json
+import numpy as np
+import pandas as pd
+import datetime as dt
+import time
+import random
+import socket
+import tempfile
+import threading
+import os
+
+from deribit_lib import (MAX_CANDLES, MONTHS, REQUEST_COST, RESOLUTIONS, YEAR, DownloadJournal, TokenBucket,
+                         async_loop, black76_price, download_units, get_data, instrument_catalog, instrument_info,
+                         instrument_info_async, read_candles, resample_columns, run_downloads, select_instruments,
+                         session)
+
+
+# =============================================================================
+# Offline testing: mock Deribit server
+# =============================================================================
+
+# A local stand-in for the Deribit websocket API with synthetic data, so that the fetch code can be
+# run and benchmarked without test.deribit.com. It answers public/get_tradingview_chart_data,
+# public/get_instrument, public/get_instruments and the trade history (public/get_last_trades_by_instrument
+# and ..._and_time), and serves chart.trades and trades subscriptions
+# with heartbeats. "latency" (seconds, with up to 50% jitter) delays every response, and with
+# "rate_limit" it keeps its own request credits like Deribit and answers "too_many_requests" once
+# they are used up. Start it, then point the session at it:
+#
+#   server = MockDeribitServer(latency=0.02)
+#   session.connect(server.start())
+
+
+class MockDeribitServer:
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, rate_limit=False, currencies=("BTC", "ETH"),
+                 first_year=2019, last_year=2022, strikes=range(10000, 70000, 5000), push_interval=1.0):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.push_interval = push_interval
+        self.trade_seq = 0
+        self.bucket = TokenBucket()
+        self.requests = 0
+        self.throttled = 0
+        self.instruments = self.synthetic_instruments(currencies, first_year, last_year, strikes)
+        self._by_name = {inst['instrument_name']: inst for inst in self.instruments}
+        self._loop = None
+        self._stop = None
+
+    # Futures expire on the last Friday of each quarter, options on the last Friday of each month (08:00 UTC)
+
+    @staticmethod
+    def synthetic_instruments(currencies, first_year, last_year, strikes):
+        instruments = []
+        now = time.time() * 1000
+
+        for currency in currencies:
+            instruments.append({
+                'instrument_name': currency + '-PERPETUAL', 'kind': 'future', 'base_currency': currency,
+                'quote_currency': 'USD', 'settlement_period': 'perpetual', 'is_active': True,
+                'creation_timestamp': 1534150800000, 'expiration_timestamp': 32503708800000,
+                'tick_size': 0.5, 'contract_size': 10, 'min_trade_amount': 10})
+
+            for year in range(first_year, last_year + 1):
+                for month in range(1, 13):
+                    last_day = dt.datetime(year + month // 12, month % 12 + 1, 1) - dt.timedelta(days=1)
+                    friday = last_day - dt.timedelta(days=(last_day.weekday() - 4) % 7)
+                    expiry = dt.datetime(friday.year, friday.month, friday.day, 8, tzinfo=dt.timezone.utc)
+                    expiration = int(expiry.timestamp() * 1000)
+                    name = f'{currency}-{expiry.day}{MONTHS[month - 1]}{year % 100}'
+                    common = {'base_currency': currency, 'quote_currency': currency, 'settlement_period': 'month',
+                              'expiration_timestamp': expiration, 'is_active': expiration > now}
+
+                    if month % 3 == 0:
+                        instruments.append(dict(common, instrument_name=name, kind='future', tick_size=0.5,
+                                                contract_size=10, min_trade_amount=10,
+                                                creation_timestamp=expiration - 273 * 86400000))
+
+                    for strike in strikes:
+                        for option_type in ['call', 'put']:
+                            instruments.append(dict(common, instrument_name=f'{name}-{strike}-{option_type[0].upper()}',
+                                                    kind='option', strike=float(strike), option_type=option_type,
+                                                    tick_size=0.0005, contract_size=1, min_trade_amount=0.1,
+                                                    creation_timestamp=expiration - 91 * 86400000))
+
+        return instruments
+
+    # Deterministic candles (the same candle always has the same values, whichever window it is requested in).
+    # Coarser resolutions are aggregated from the minute candles, like on Deribit
+
+    def minute_candles(self, instrument_name, ticks):
+        instrument = self._by_name.get(instrument_name, {})
+        if instrument.get('kind') == 'option':
+            return self.option_minute_candles(instrument, ticks)
+
+        seed = sum(map(ord, instrument_name))
+        price = lambda t: 20000 + 5000 * np.sin(t / 8.64e8 + seed) + 50 * np.sin(t / 3.6e6)
+        opens = price(ticks)
+        closes = price(ticks + 60000)
+        volume = 1.0 + (ticks // 60000) % 7
+
+        return {'ticks': ticks, 'open': opens, 'high': np.maximum(opens, closes) + 10,
+                'low': np.minimum(opens, closes) - 10, 'close': closes, 'volume': volume, 'cost': volume * closes}
+
+    # Options are priced with Black-76 at OPTION_VOL from their underlying (the future of the same expiry,
+    # or the perpetual contract), in the underlying currency like on Deribit
+
+    OPTION_VOL = 0.8
+
+    def option_minute_candles(self, instrument, ticks):
+        future = instrument['instrument_name'].rsplit('-', 2)[0]
+        underlying = self.minute_candles(future if future in self._by_name else instrument['base_currency'] + '-PERPETUAL',
+                                         ticks)
+
+        def price(f, t):
+            years = np.maximum(instrument['expiration_timestamp'] - t, 1) / (YEAR / dt.timedelta(milliseconds=1))
+            return black76_price(f, instrument['strike'], years, self.OPTION_VOL, instrument['option_type'] == 'call') / f
+
+        opens = price(underlying['open'], ticks)
+        closes = price(underlying['close'], ticks + 60000)
+        volume = 0.1 * (1 + (ticks // 60000) % 7)
+
+        return {'ticks': ticks, 'open': opens, 'high': np.maximum(opens, closes), 'low': np.minimum(opens, closes),
+                'close': closes, 'volume': volume, 'cost': volume * closes}
+
+    def candles(self, params):
+        step = int(RESOLUTIONS[str(params['resolution'])].total_seconds() * 1000)
+        instrument = self._by_name.get(params['instrument_name'])
+
+        start = int(params['start_timestamp'])
+        end = int(params['end_timestamp'])
+        created, expired = -np.inf, np.inf
+        if instrument is not None:
+            created, expired = instrument['creation_timestamp'], instrument['expiration_timestamp']
+            start = max(start, created)
+            end = min(end, expired)
+
+        ticks = np.arange(-(-start // step) * step, end + 1, step, dtype='int64')[-MAX_CANDLES:]
+        if len(ticks) == 0:
+            return {'ticks': [], 'open': [], 'high': [], 'low': [], 'close': [], 'volume': [], 'cost': [],
+                    'status': 'no_data'}
+
+        minutes = np.arange(ticks[0], ticks[-1] + step, 60000, dtype='int64')
+        minutes = minutes[(minutes >= created) & (minutes <= expired)]
+        result = self.minute_candles(params['instrument_name'], minutes)
+        if step > 60000:
+            result = resample_columns(result, params['resolution'])
+
+        return dict({col: values.tolist() for col, values in result.items()}, status='ok')
+
+    # Deterministic trades: TRADES_PER_HOUR per hour since the creation of the instrument, the first
+    # BURST of them in the same millisecond at the start of the hour (more than one page)
+
+    TRADES_PER_HOUR = 5000
+    BURST = 1200
+
+    def trade_timestamps(self, instrument, seqs):
+        first = -(-instrument['creation_timestamp'] // 3600000) * 3600000
+        spacing = 3600000 // (self.TRADES_PER_HOUR - self.BURST + 1)
+        hour, j = np.divmod(seqs - 1, self.TRADES_PER_HOUR)
+
+        return first + hour * 3600000 + np.maximum(j - self.BURST + 1, 0) * spacing
+
+    def trades(self, instrument, params):
+        count = int(params.get('count', 10))
+        last = min(instrument['expiration_timestamp'], int(time.time() * 1000))
+
+        if 'start_seq' in params:
+            seqs = np.arange(int(params['start_seq']), int(params['start_seq']) + count + 1)
+            ticks = self.trade_timestamps(instrument, seqs)
+            valid = ticks <= last
+        else:
+            first = -(-instrument['creation_timestamp'] // 3600000) * 3600000
+            hour = max(0, (int(params['start_timestamp']) - first) // 3600000)
+            seqs = np.arange(hour * self.TRADES_PER_HOUR + 1, (hour + 2) * self.TRADES_PER_HOUR + 1)
+            ticks = self.trade_timestamps(instrument, seqs)
+            valid = (ticks >= int(params['start_timestamp'])) & (ticks <= min(int(params['end_timestamp']), last))
+
+        seqs, ticks = seqs[valid][:count + 1], ticks[valid][:count + 1]
+        has_more = len(seqs) > count
+        seqs, ticks = seqs[:count], ticks[:count]
+
+        name = instrument['instrument_name']
+        prices = self.minute_candles(name, ticks - ticks % 60000)['close']
+        prefix = '' if instrument['base_currency'] == 'BTC' else instrument['base_currency'] + '-'
+        trades = [{'trade_id': f'{prefix}{seq}', 'trade_seq': int(seq), 'timestamp': int(tick),
+                   'instrument_name': name, 'price': float(price), 'amount': float(10 * (1 + seq % 5)),
+                   'direction': 'buy' if seq % 3 else 'sell', 'tick_direction': int(seq % 4),
+                   'index_price': float(price), 'mark_price': float(price)}
+                  for seq, tick, price in zip(seqs.tolist(), ticks.tolist(), prices.tolist())]
+        if instrument['kind'] == 'option':
+            for trade in trades:
+                trade['iv'] = 50.0 + trade['trade_seq'] % 10
+
+        return {'trades': trades, 'has_more': has_more}
+
+    def answer(self, msg, connection=None):
+        method = msg.get('method')
+        params = msg.get('params', {})
+
+        if self.rate_limit:
+            with self.bucket._lock:
+                self.bucket._refill()
+                allowed = self.bucket.tokens >= REQUEST_COST
+                if allowed:
+                    self.bucket.tokens -= REQUEST_COST
+            if not allowed:
+                self.throttled += 1
+                return {'error': {'code': 10028, 'message': 'too_many_requests'}}
+
+        if method == 'public/get_tradingview_chart_data':
+            return {'result': self.candles(params)}
+
+        if method in ('public/get_last_trades_by_instrument_and_time', 'public/get_last_trades_by_instrument'):
+            instrument = self._by_name.get(params.get('instrument_name'))
+            if instrument is None:
+                return {'error': {'code': 13020, 'message': 'not_found'}}
+            return {'result': self.trades(instrument, params)}
+
+        if method == 'public/get_instrument':
+            instrument = self._by_name.get(params.get('instrument_name'))
+            if instrument is None:
+                return {'error': {'code': 13020, 'message': 'not_found'}}
+            return {'result': instrument}
+
+        if method == 'public/get_instruments':
+            now = time.time() * 1000
+            expired = bool(params.get('expired', False))
+            return {'result': [inst for inst in self.instruments
+                               if inst['base_currency'] == params.get('currency')
+                               and inst['kind'] == params.get('kind', inst['kind'])
+                               and (inst['expiration_timestamp'] <= now) == expired]}
+
+        if method == 'public/test':
+            return {'result': {'version': 'mock'}}
+
+        if method == 'public/set_heartbeat' and connection is not None:
+            connection['tasks'].append(asyncio.ensure_future(self._heartbeat(connection, params['interval'])))
+            return {'result': 'ok'}
+
+        if method == 'public/subscribe' and connection is not None:
+            channels = [channel for channel in params.get('channels', [])
+                        if channel.startswith('chart.trades.') or channel.startswith('trades.')]
+            if not connection['channels']:
+                connection['tasks'].append(asyncio.ensure_future(self._push(connection)))
+            connection['channels'].update(channels)
+            return {'result': channels}
+
+        return {'error': {'code': -32601, 'message': 'Method not found'}}
+
+    # Subscriptions: every "push_interval" seconds the candle being formed is sent on each chart.trades
+    # channel (Deribit sends it after every trade), and a trade on each trades channel
+
+    def notification(self, channel, now):
+        if channel.startswith('chart.trades.'):
+            instrument, resolution = channel[len('chart.trades.'):].rsplit('.', 1)
+            step = int(RESOLUTIONS[resolution].total_seconds() * 1000)
+            minutes = np.arange(now - now % step, now - now % 60000 + 1, 60000, dtype='int64')
+            candle = resample_columns(self.minute_candles(instrument, minutes), resolution)
+            return dict({col: float(values[0]) for col, values in candle.items() if col != 'ticks'},
+                        tick=int(candle['ticks'][0]))
+
+        instrument = channel[len('trades.'):].rsplit('.', 1)[0]
+        self.trade_seq += 1
+        price = float(self.minute_candles(instrument, np.array([now - now % 60000]))['close'][0])
+        return [{'trade_id': str(self.trade_seq), 'trade_seq': self.trade_seq, 'timestamp': now,
+                 'instrument_name': instrument, 'price': price, 'amount': 10.0,
+                 'direction': random.choice(['buy', 'sell']), 'tick_direction': 0,
+                 'index_price': price, 'mark_price': price}]
+
+    async def _push(self, connection):
+        while True:
+            await asyncio.sleep(self.push_interval)
+            now = int(time.time() * 1000)
+            for channel in list(connection['channels']):
+                await connection['websocket'].send(json.dumps(
+                    {'jsonrpc': '2.0', 'method': 'subscription',
+                     'params': {'channel': channel, 'data': self.notification(channel, now)}}))
+
+    async def _heartbeat(self, connection, interval):
+        while True:
+            await asyncio.sleep(interval)
+            await connection['websocket'].send(json.dumps(
+                {'jsonrpc': '2.0', 'method': 'heartbeat', 'params': {'type': 'test_request'}}))
+
+    async def _respond(self, websocket, message, connection):
+        msg = json.loads(message)
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+
+        response = dict(self.answer(msg, connection), jsonrpc='2.0', id=msg.get('id'))
+        try:
+            await websocket.send(json.dumps(response))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _handler(self, websocket, path=None):
+        tasks = set()
+        connection = {'websocket': websocket, 'channels': set(), 'tasks': []}
+        try:
+            async for message in websocket:
+                task = asyncio.ensure_future(self._respond(websocket, message, connection))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in connection['tasks']:
+                task.cancel()
+
+    async def _serve(self, sock, ready):
+        self._stop = asyncio.get_running_loop().create_future()
+        async with websockets.serve(self._handler, sock=sock, max_size=None):
+            ready.set()
+            await self._stop
+
+    # Runs the server in its own thread and returns its url
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+
+        ready = threading.Event()
+        self._loop = asyncio.new_event_loop()
+        threading.Thread(target=self._loop.run_until_complete, args=(self._serve(sock, ready),),
+                         name='mock-deribit', daemon=True).start()
+        ready.wait()
+
+        return self.url
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._stop.set_result, None)
+
+    @property
+    def url(self):
+        return f'ws://{self.host}:{self.port}'
+
+
+# =============================================================================
+# Benchmark: fetch throughput against the mock server
+# =============================================================================
+
+# Each scenario reports requests/s, candles/s, the p50/p99 latency of single requests (send to response)
+# and the peak RSS of the process so far (it never goes down, so compare scenarios in the order they ran).
+# With unlimited=True the client's token bucket is switched off to measure the fetch code itself.
+# Nothing goes into the candle or instrument caches: the candles of the mock are made up.
+
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if os.uname().sysname == 'Darwin' else peak / 2**10
+    except ImportError:
+        try:
+            import psutil
+            return psutil.Process().memory_info().peak_wset / 2**20
+        except (ImportError, AttributeError):
+            return np.nan
+
+
+def benchmark_scenario(name, run):
+    latencies = []
+    errors = []
+
+    def observer(method, seconds, n_bytes, error):
+        if seconds is not None:
+            latencies.append(seconds)
+        if error is not None:
+            errors.append(error)
+
+    session.observers.append(observer)
+    try:
+        t0 = time.perf_counter()
+        candles = run()
+        seconds = time.perf_counter() - t0
+    finally:
+        session.observers.remove(observer)
+
+    latencies = np.array(latencies) * 1000
+    return {'scenario': name,
+            'requests': len(latencies),
+            'errors': len(errors),
+            'seconds': seconds,
+            'requests_per_s': len(latencies) / seconds,
+            'candles_per_s': candles / seconds,
+            'p50_ms': np.percentile(latencies, 50) if len(latencies) else np.nan,
+            'p99_ms': np.percentile(latencies, 99) if len(latencies) else np.nan,
+            'peak_rss_mb': peak_rss_mb()}
+
+
+def benchmark_fetch(latency=0.02, unlimited=True, n_info=200):
+    server = MockDeribitServer(latency=latency, rate_limit=not unlimited)
+    url, limiter = session.url, session.limiter
+    session.connect(server.start())
+    if unlimited:
+        session.limiter = TokenBucket(float('inf'), float('inf'))
+
+    catalog = instrument_catalog(["BTC"], ["option", "future"])
+    options = select_instruments(catalog, "option", "2021-03", "2021-03")
+    names = catalog.index.get_level_values('instrument_name')[:n_info]
+
+    async def instrument_info_gathered():
+        return await asyncio.gather(*[instrument_info_async(name, cache=None) for name in names])
+
+    def batch(tf):
+        with tempfile.TemporaryDirectory() as directory:
+            journal = DownloadJournal(os.path.join(directory, 'journal.sqlite'))
+            journal.add(download_units(options, [tf]))
+            run_downloads(journal, root=os.path.join(directory, 'store'), cache=None)
+            journal.close()
+            return len(read_candles(os.path.join(directory, 'store'), columns=['timestamp']))
+
+    scenarios = [
+        ('get_data 1 year, tf="1"', lambda: len(get_data(dt.datetime(2020, 1, 1), dt.datetime(2021, 1, 1),
+                                                          "BTC-PERPETUAL", "1", cache=None))),
+        ('get_data 3 years, tf="60"', lambda: len(get_data(dt.datetime(2018, 8, 13), dt.datetime(2021, 8, 13),
+                                                            "BTC-PERPETUAL", "60", cache=None))),
+        ('instrument_info sequential', lambda: len([instrument_info(name, cache=None) for name in names])),
+        ('instrument_info gathered', lambda: len(async_loop(instrument_info_gathered))),
+        ('batch options, tf="1D"', lambda: batch("1D")),
+        ('batch options, tf="60"', lambda: batch("60")),
+    ]
+
+    try:
+        rows = [benchmark_scenario(name, run) for name, run in scenarios]
+    finally:
+        session.connect(url)
+        session.limiter = limiter
+        server.stop()
+
+    # Every request has to have reached the mock server, none the real API
+    sent = sum(row['requests'] for row in rows)
+    if server.requests < sent:
+        raise RuntimeError(f'{sent - server.requests} of {sent} requests did not go to the mock server')
+
+    return pd.DataFrame(rows).set_index('scenario')
@@ -0,0 +1,299 @@
+# Regression checks against the mock server (python -m pytest test_deribit.py)
+
+import asyncio
+import datetime as dt
+import time
+import tracemalloc
+import types
+import pandas as pd
+import pytest
+
+import deribit_lib as lib
+from deribit_mock import MockDeribitServer, benchmark_fetch
+
+
+@pytest.fixture
+def server():
+    server = MockDeribitServer()
+    url, limiter = lib.session.url, lib.session.limiter
+    lib.session.connect(server.start())
+    lib.session.limiter = lib.TokenBucket(float('inf'), float('inf'))
+    yield server
+    lib.session.connect(url)
+    lib.session.limiter = limiter
+    server.stop()
+
+
+def test_get_data(server):
+    df = lib.get_data(dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 10), "BTC-PERPETUAL", "60", cache=None)
+
+    assert len(df) == 4 * 24 + 1
+    assert df.index.is_monotonic_increasing and not df.index.has_duplicates
+
+
+def test_in_flight_gauge_drops_back_after_requests(server):
+    lib.get_data(dt.datetime(2021, 1, 1), dt.datetime(2021, 2, 1), "BTC-PERPETUAL", "1", cache=None)
+
+    assert lib.metrics.snapshot()['gauges']['in_flight'] == 0
+
+
+def test_connect_closes_connections_to_previous_server(server):
+    lib.get_data(dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 7), "BTC-PERPETUAL", "60", cache=None)
+
+    other = MockDeribitServer()
+    lib.session.connect(other.start())
+    try:
+        requests = server.requests
+        lib.get_data(dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 7), "BTC-PERPETUAL", "60", cache=None)
+        assert server.requests == requests
+        assert other.requests > 0
+    finally:
+        other.stop()
+
+
+def test_adaptive_window_passes_on_wakeup_of_cancelled_waiter():
+    async def run():
+        window = lib.AdaptiveWindow(initial=1, maximum=1)
+        await window.acquire()
+        a = asyncio.ensure_future(window.acquire())
+        b = asyncio.ensure_future(window.acquire())
+        await asyncio.sleep(0)
+
+        window.release()        # wakes a
+        a.cancel()              # ... which is cancelled before it runs
+        await asyncio.wait_for(b, 1)
+        return window.in_flight
+
+    assert asyncio.run(run()) == 1
+
+
+def test_client_slows_down_to_server_rate_limit():
+    server = MockDeribitServer(rate_limit=True)
+    server.bucket = lib.TokenBucket(2500, 25000)        # the server allows 50 requests per second
+    session = lib.DeribitSession(server.start(), limiter=lib.TokenBucket(5000, 50000), metrics=None)
+    names = [instrument['instrument_name'] for instrument in server.instruments[:300]]
+
+    def instrument_msg(name):
+        return {"jsonrpc": "2.0", "method": "public/get_instrument", "params": {"instrument_name": name}}
+
+    async def run():
+        try:
+            return await asyncio.gather(*[session.call(instrument_msg(name)) for name in names])
+        finally:
+            await session.close()
+
+    try:
+        asyncio.run(run())
+    finally:
+        server.stop()
+
+    assert server.throttled < 0.1 * server.requests
+
+
+def test_get_data_of_a_single_candle(server):
+    t = dt.datetime(2021, 2, 6, 12, tzinfo=dt.timezone.utc)
+    df = lib.get_data(t, t, "BTC-PERPETUAL", "1", cache=None)
+
+    assert list(df.index) == [pd.Timestamp(t)]
+
+
+def test_live_collector_fills_a_gap_of_one_candle(server, tmp_path):
+    collector = lib.LiveCollector(["BTC-PERPETUAL"], tfs=["1"], directory=str(tmp_path))
+    series = next(iter(collector.series.values()))
+
+    now = int(time.time() * 1000)
+    complete = now - now % 60000 - 60000
+    series['last'] = complete - 60000          # only the candle at "complete" is missing
+
+    lib.async_loop(collector._flush_series, series, now)
+
+    assert list(lib.MemmapSeries(series['path']).ticks) == [complete]
+    assert series['last'] == complete
+
+
+def test_underlying_prices_raises_without_candles(server, tmp_path):
+    df = lib.get_data(dt.datetime(2021, 3, 1), dt.datetime(2021, 3, 5), "BTC-26MAR21", "1D", cache=None)
+    panel = types.SimpleNamespace(expiry="2021-03-26", tf="1D", times=df.index)
+
+    with pytest.raises(ValueError):
+        lib.underlying_prices(panel, "BTC-26MAR21", root=str(tmp_path))
+
+    lib.write_candles(df, "BTC-26MAR21", "1D", "BTC", "future", "2021-03-26", root=str(tmp_path))
+    assert (lib.underlying_prices(panel, "BTC-26MAR21", root=str(tmp_path)) == df['close'].to_numpy()).all()
+
+
+def test_iter_candles_requests_only_what_the_cache_misses(server, tmp_path):
+    start, end = dt.datetime(2021, 1, 1), dt.datetime(2021, 2, 1)
+    cache = lib.CandleCache(str(tmp_path))
+    lib.get_data(dt.datetime(2021, 1, 10), dt.datetime(2021, 1, 20), "BTC-PERPETUAL", "1", cache=cache)
+
+    requests = server.requests
+    df = pd.concat(lib.iter_candles(start, end, "BTC-PERPETUAL", "1", max_candles=1000, cache=cache))
+    cached = server.requests - requests
+
+    requests = server.requests
+    expected = pd.concat(lib.iter_candles(start, end, "BTC-PERPETUAL", "1", max_candles=1000, cache=None))
+
+    assert cached < 0.7 * (server.requests - requests)
+    assert df.index.is_monotonic_increasing and not df.index.has_duplicates
+    pd.testing.assert_frame_equal(df, expected[df.columns], check_freq=False)
+
+    # The streamed windows went into the cache as well
+    requests = server.requests
+    again = pd.concat(lib.iter_candles(start, end, "BTC-PERPETUAL", "1", max_candles=1000, cache=cache))
+    assert server.requests == requests
+    pd.testing.assert_frame_equal(again, df, check_freq=False)
+
+
+def test_candle_cache_reads_only_the_blocks_of_a_range(server, tmp_path, monkeypatch):
+    cache = lib.CandleCache(str(tmp_path), block=1000)
+    df = lib.get_data(dt.datetime(2021, 1, 1), dt.datetime(2021, 1, 15), "BTC-PERPETUAL", "1", cache=cache)
+
+    rows = []
+    read_parquet = pd.read_parquet
+
+    def counting_read_parquet(*args, **kwargs):
+        df = read_parquet(*args, **kwargs)
+        rows.append(len(df))
+        return df
+
+    monkeypatch.setattr(pd, "read_parquet", counting_read_parquet)
+
+    t1 = lib.to_ms(dt.datetime(2021, 1, 5))
+    part = cache.load("BTC-PERPETUAL", "1", t1, t1 + 500 * 60000)
+    assert len(part) == 501 and max(rows) <= 1000 and len(rows) <= 2
+    pd.testing.assert_frame_equal(part, df.loc[part.index[0]:part.index[-1]], check_freq=False)
+
+
+def test_candle_cache_converts_pickles_of_earlier_versions(tmp_path):
+    df = pd.DataFrame({col: [1.0, 2.0] for col in lib.CANDLE_COLUMNS},
+                      index=pd.DatetimeIndex(["2021-01-01", "2021-01-02"], tz="UTC", name="timestamp"))
+    covered = [(lib.to_ms(df.index[0]), lib.to_ms(df.index[-1]))]
+    pd.to_pickle({'candles': df, 'covered': covered}, tmp_path / "BTC-PERPETUAL_1D.pkl")
+
+    cache = lib.CandleCache(str(tmp_path))
+    assert cache.missing("BTC-PERPETUAL", "1D", *covered[0]) == []
+    pd.testing.assert_frame_equal(cache.load("BTC-PERPETUAL", "1D"), df, check_freq=False)
+    assert not (tmp_path / "BTC-PERPETUAL_1D.pkl").exists()
+
+
+
+@pytest.mark.parametrize("timestamps", [["2021-01-01 00:01:00", "2021-01-01 00:02:00", "2021-01-01 00:02:30"],
+                                        ["2021-01-01 00:01:00+00:00", "2021-01-01 01:02:00+01:00", "x"],
+                                        ["2021-01-01T00:01:00Z", "01/01/2021 00:02", None]])
+def test_read_legacy_csv(tmp_path, timestamps):
+    path = tmp_path / "legacy.csv"
+    pd.DataFrame({"timestamp": timestamps, "open": [1.0, 2.0, 3.0], "high": [2.0, 3.0, 4.0],
+                  "low": [0.5, 1.0, 2.0], "close": [1.5, 2.5, 3.5], "volume": [1.0, 0.0, 1.0],
+                  "cost": [9.0, 0.0, 9.0]}).to_csv(path, index=False)
+
+    candles, invalid = lib.read_legacy_csv(str(path), "1")
+
+    assert invalid == 1
+    assert candles.index.equals(pd.DatetimeIndex(["2021-01-01 00:01", "2021-01-01 00:02"], tz="UTC"))
+    assert candles["open"].tolist() == [1.0, 2.0]
+
+def test_import_legacy(server, tmp_path):
+    df = lib.get_data(dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 8), "BTC-26MAR21", "1", cache=None)
+    (tmp_path / "archive" / "Minutely").mkdir(parents=True)
+    df.to_csv(tmp_path / "archive" / "Minutely" / "future-minutely_BTC-26MAR21.csv")
+
+    root, cache = str(tmp_path / "store"), lib.CandleCache(str(tmp_path / "cache"))
+    result = lib.import_legacy(str(tmp_path / "archive"), root=root, workers=2, cache=cache)
+
+    assert result["imported"].tolist() == [len(df)] and result["error"].isna().all()
+    assert cache.missing("BTC-26MAR21", "1", lib.to_ms(df.index[0]), lib.to_ms(df.index[-1])) == []
+    assert len(lib.read_candles(root, tf="1")) == len(df)
+    assert len(lib.import_legacy(str(tmp_path / "archive"), root=root, cache=cache)) == 0
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_instrument_info_of_unknown_instrument(server, tmp_path, cached):
+    cache = lib.InstrumentCache(str(tmp_path / "instruments.sqlite")) if cached else None
+
+    assert lib.instrument_info("BTC-26MAR21", cache=cache).loc[0, "instrument_name"] == "BTC-26MAR21"
+    with pytest.raises(lib.DeribitError):
+        lib.instrument_info("BTC-1JAN99", cache=cache)
+
+
+@pytest.fixture
+def berlin_time(monkeypatch):
+    monkeypatch.setenv("TZ", "Europe/Berlin")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_naive_datetimes_are_utc(server, tmp_path, berlin_time):
+    start, end = dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 7)
+    df = lib.get_data(start, end, "BTC-PERPETUAL", "60", cache=None)
+
+    assert df.index[0] == pd.Timestamp(start, tz="UTC") and df.index[-1] == pd.Timestamp(end, tz="UTC")
+    chunks = list(lib.iter_candles(start, end, "BTC-PERPETUAL", "60", cache=None))
+    assert chunks[0].index[0] == df.index[0] and chunks[-1].index[-1] == df.index[-1]
+
+    lib.write_memmap(df, str(tmp_path))
+    assert len(lib.MemmapSeries(str(tmp_path)).slice(start, end)['ticks']) == len(df) == 25
+
+    trades = lib.get_trades(start, start + dt.timedelta(hours=1), "BTC-PERPETUAL")
+    assert len(trades) and trades.index[0] >= pd.Timestamp(start, tz="UTC")
+    assert trades.index[-1] <= pd.Timestamp(start + dt.timedelta(hours=1), tz="UTC")
+
+
+def test_permanent_errors_are_raised_as_deribit_errors(server, monkeypatch):
+    answer = server.answer
+
+    def refuse(msg, connection=None):
+        if msg['method'] in ('public/get_tradingview_chart_data', 'public/get_last_trades_by_instrument_and_time'):
+            return {'error': {'code': 10009, 'message': 'not_enough_funds'}}
+        return answer(msg, connection)
+
+    monkeypatch.setattr(server, "answer", refuse)
+    start, end = dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 7)
+
+    for download in [lambda: lib.get_data(start, end, "BTC-PERPETUAL", "60", cache=None),
+                     lambda: list(lib.iter_candles(start, end, "BTC-PERPETUAL", "60", cache=None)),
+                     lambda: lib.get_trades(start, end, "BTC-PERPETUAL")]:
+        with pytest.raises(lib.DeribitError) as e:
+            download()
+        assert e.value.code == 10009
+
+
+def test_get_data_reserves_rows_by_window_size(server):
+    tracemalloc.start()
+    try:
+        df = lib.get_data(dt.datetime(2020, 1, 1), dt.datetime(2021, 1, 1), "BTC-PERPETUAL", "1D",
+                          window=dt.timedelta(days=1), cache=None)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    assert len(df) == 367
+    assert peak < 20 * 2**20
+
+
+def test_benchmark_fetch_leaves_the_candle_cache_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(lib.candle_cache, "directory", str(tmp_path / "candles"))
+
+    df = benchmark_fetch(latency=0, n_info=10)
+
+    assert (df["errors"] == 0).all()
+    assert not (tmp_path / "candles").exists()
+
+
+def test_download_trades_append_requests_only_the_new_range(server, tmp_path):
+    start, middle, end = dt.datetime(2021, 2, 6), dt.datetime(2021, 2, 6, 6), dt.datetime(2021, 2, 6, 7)
+    lib.download_trades(start, middle, "BTC-PERPETUAL", str(tmp_path / "appended"))
+
+    requests = server.requests
+    lib.download_trades(start, end, "BTC-PERPETUAL", str(tmp_path / "appended"), append=True)
+    appended = server.requests - requests
+
+    requests = server.requests
+    lib.download_trades(start, end, "BTC-PERPETUAL", str(tmp_path / "whole"))
+
+    assert appended < 0.5 * (server.requests - requests)
+    for col in ["ticks", "trade_seq", "price"]:
+        assert (lib.MemmapSeries(str(tmp_path / "appended"), lib.TRADE_COLUMNS).columns[col] ==
+                lib.MemmapSeries(str(tmp_path / "whole"), lib.TRADE_COLUMNS).columns[col]).all()